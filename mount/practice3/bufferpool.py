@@ -0,0 +1,91 @@
+'''固定形状のフレーム用バッファを使い回すためのモジュール。
+10 ms ごとのフレームのたびに配列を確保すると、ストリーム数が多い場合に
+メモリの確保と解放の負荷が目立つため、決まった形状の配列を
+プールから acquire() し、使い終わったら release() で返す。
+プールが空のときだけ新しい配列を確保し、その回数を allocations に数える。
+運用中に allocations が増え続ける場合はプールの大きさが足りていない。
+'''
+
+import collections
+
+import numpy as np
+
+
+# フレームの形状と型（8ch、ADVANCE=160、LENGTH=512 の場合）
+FRAME_SHAPES = {
+    "block": ((8, 160), np.int16),       # Publisher に送る入力ブロック
+    "spec": ((8, 257), np.complex64),    # MultiFFT の出力スペクトル
+}
+
+
+class BufferPool:
+    '''shape・dtype の配列を size 個まで保持して使い回すプール。
+    acquire() と release() は別々のスレッドから呼んでよい
+    （空き配列の受け渡しには deque の append と pop のみを使う）。
+    '''
+
+    def __init__(self, shape, dtype, size=64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.allocations = 0
+        self.acquired = 0
+        self.released = 0
+        self._free = collections.deque()
+        for _ in range(size):
+            self._free.append(self._allocate())
+
+    def _allocate(self):
+        self.allocations += 1
+        return np.empty(self.shape, dtype=self.dtype)
+
+    @property
+    def in_use(self):
+        return self.acquired - self.released
+
+    @property
+    def grown(self):
+        '''プールが空で新たに確保した回数。'''
+        return self.allocations - self.size
+
+    def acquire(self):
+        '''空き配列を返す。空いていなければ新しく確保する。
+        返す配列の内容は不定。
+        '''
+        self.acquired += 1
+        try:
+            return self._free.pop()
+        except IndexError:
+            return self._allocate()
+
+    def release(self, a):
+        '''acquire() で得た配列をプールに返す。'''
+        self.released += 1
+        if len(self._free) < self.size:
+            self._free.append(a)
+
+    def copy(self, src):
+        '''src の内容をコピーした配列をプールから取り出して返す。'''
+        a = self.acquire()
+        np.copyto(a, src)
+        return a
+
+
+def register(registry, pools):
+    '''各プールの確保回数と使用中の配列数をメトリクスとして公開する。'''
+    for name, pool in pools.items():
+        labels = {"pool": name}
+        registry.counter(
+            "buffer_pool_allocations_total",
+            "Arrays allocated by each frame buffer pool.",
+            labels, func=lambda pool=pool: pool.allocations)
+        registry.counter(
+            "buffer_pool_grown_total",
+            "Allocations made because the pool was empty.",
+            labels, func=lambda pool=pool: pool.grown)
+        registry.gauge(
+            "buffer_pool_in_use",
+            "Arrays currently acquired from each pool.",
+            labels, func=lambda pool=pool: pool.in_use)
+
+# end of file
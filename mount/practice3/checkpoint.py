@@ -0,0 +1,146 @@
+'''長時間の処理の途中経過（チェックポイント）を保存・読み込むモジュール。
+状態は JSON で、分離行列などのファイルは別ファイルとして保存する。
+書き込みは別スレッドで行い、一時ファイルに書いて fsync したのち
+os.replace で置き換えるため、途中で異常終了しても
+直前のチェックポイントが壊れることはない。
+添付ファイルはチェックポイントごとに別の名前で保存し、
+JSON を置き換えた後で古いものを削除する。
+'''
+
+import json
+import os
+import shutil
+import threading
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _atomic_write(path, write):
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+class Checkpointer:
+    '''path にチェックポイントを保存するクラス。
+
+        checkpointer = Checkpointer("run.ckpt")
+        state = checkpointer.load()            # 無ければ None
+        ...
+        checkpointer.submit({"frame": t}, files={"ghdss": w_filename})
+        ...
+        checkpointer.close()
+
+    submit() は待たずに戻る。書き込み中に次の submit() があった場合は
+    最新の状態だけを書く。
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.errors = 0
+        self._seq = 0
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def load(self):
+        '''保存されている状態を返す。無い場合は None を返す。
+        添付ファイルは state["files"] に {名前: パス} で入っている。
+        '''
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        self._seq = state.get("seq", 0)
+        return state
+
+    def submit(self, state, files=None):
+        '''state（JSON に変換できる辞書）と添付ファイル {名前: パス} の保存を依頼する。
+        添付ファイルは書き込みの時点の内容を保存する。
+        '''
+        with self._cond:
+            self._pending = (dict(state), dict(files or {}))
+            self._cond.notify()
+
+    def _write(self, state, files):
+        self._seq += 1
+        state["seq"] = self._seq
+        state["files"] = {}
+        for name, src in files.items():
+            if src is None or not os.path.exists(src):
+                continue
+            dst = "{}.{}.{}{}".format(self.path, self._seq, name,
+                                      os.path.splitext(src)[1])
+
+            def copy(f, src=src):
+                with open(src, "rb") as s:
+                    shutil.copyfileobj(s, f)
+
+            _atomic_write(dst, copy)
+            state["files"][name] = dst
+
+        previous = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                previous = json.load(f).get("files", {})
+        _atomic_write(self.path, lambda f: f.write(
+            json.dumps(state, indent=1).encode("utf-8")))
+        # 新しいチェックポイントが参照しない古い添付ファイルを消す
+        for old in (previous or {}).values():
+            if old not in state["files"].values() and os.path.exists(old):
+                os.remove(old)
+        self.written += 1
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    break
+                state, files = self._pending
+                self._pending = None
+            try:
+                self._write(state, files)
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                print("checkpoint failed: {}: {}".format(
+                    type(e).__name__, e))
+
+    def close(self):
+        '''書き込み待ちの状態を書き終えてからスレッドを止める。'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def remove(self):
+        '''処理が最後まで終わった場合に、チェックポイントと添付ファイルを消す。'''
+        self.close()
+        state = self.load()
+        if state is None:
+            return
+        for path in state.get("files", {}).values():
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(self.path)
+
+# end of file
@@ -0,0 +1,83 @@
+'''オンライン音源定位のための空間相関行列の逐次更新。
+LocalizeMUSIC は WINDOW フレーム分の外積を毎回平均し直すが、
+ここでは最新フレームの外積を加え、窓から外れたフレームの外積を引くことで
+フレームあたり O(ビン数 x チャネル数^2) で相関行列を更新する。
+指数忘却による更新も選べる。
+'''
+
+import numpy as np
+
+
+class SlidingCovariance:
+    '''周波数ビンごとの空間相関行列を1フレームずつ更新するクラス。
+
+    window:         平均するフレーム数（LocalizeMUSIC の WINDOW）
+    forgetting:     None 以外を与えると、窓の代わりに忘却係数
+                    R = forgetting * R + (1 - forgetting) * x x^H で更新する
+    resum_interval: 加算と減算の繰り返しによる数値誤差の蓄積を防ぐため、
+                    このフレーム数ごとに窓内のフレームから和を計算し直す
+    '''
+
+    def __init__(self, nch, nbin, window=50, forgetting=None,
+                 resum_interval=1000):
+        self.nch = nch
+        self.nbin = nbin
+        self.window = window
+        self.forgetting = forgetting
+        self.resum_interval = resum_interval
+
+        self._sum = np.zeros((nbin, nch, nch), dtype=np.complex128)
+        self._mean = np.zeros((nbin, nch, nch), dtype=np.complex64)
+        # 窓から外れるフレームの外積を引くため、窓内のフレームを保持する
+        self._ring = np.zeros((window, nbin, nch), dtype=np.complex64)
+        self._pos = 0
+        self.count = 0
+        self.frames = 0
+
+    def reset(self):
+        '''相関行列と保持しているフレームを初期化する。'''
+        self._sum[...] = 0.0
+        self._mean[...] = 0.0
+        self._ring[...] = 0.0
+        self._pos = 0
+        self.count = 0
+        self.frames = 0
+
+    def _resum(self):
+        ring = self._ring[:self.count]
+        self._sum[...] = np.einsum("tbi,tbj->bij", ring, np.conj(ring))
+
+    def update(self, x):
+        '''1フレーム分のスペクトル (チャネル数, ビン数) を加え、
+        現在の相関行列 (ビン数, チャネル数, チャネル数) を返す。
+        返す配列は内部バッファなので、保持する場合はコピーすること。
+        '''
+        x = x.T
+        outer = x[:, :, None] * np.conj(x[:, None, :])
+        self.frames += 1
+
+        if self.forgetting is not None:
+            if self.frames == 1:
+                self._sum[...] = outer
+            else:
+                self._sum *= self.forgetting
+                self._sum += (1.0 - self.forgetting) * outer
+            self._mean[...] = self._sum
+            return self._mean
+
+        if self.count == self.window:
+            old = self._ring[self._pos]
+            self._sum -= old[:, :, None] * np.conj(old[:, None, :])
+        else:
+            self.count += 1
+        self._ring[self._pos] = x
+        self._pos = (self._pos + 1) % self.window
+
+        if self.frames % self.resum_interval == 0:
+            self._resum()
+        else:
+            self._sum += outer
+        np.divide(self._sum, self.count, out=self._mean, casting="unsafe")
+        return self._mean
+
+# end of file
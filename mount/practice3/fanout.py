@@ -0,0 +1,265 @@
+'''SubscribeData の結果を複数の利用者（ダッシュボード・保存・追跡など）に
+配信するモジュール。
+結果は1回だけバイナリ形式（小さなヘッダと NumPy 配列のバッファ）に変換し、
+Unixドメインソケットで接続した各利用者に同じバイト列を送る。
+利用者はトピック（"sources", "separation", "features" など）を選んで購読する。
+利用者ごとに上限付きのキューをもち、送信は利用者ごとのスレッドで行うため、
+遅い利用者がいてもネットワークの実行は止まらない
+（キューがあふれた場合は古いメッセージから捨てて dropped に数える）。
+'''
+
+import collections
+import os
+import socket
+import struct
+import threading
+
+import numpy as np
+
+
+# メッセージ: [全体の長さ u32][ヘッダ][配列...]
+# ヘッダ:     マジック, トピック長, 配列数, フレーム番号, 時刻[ns], トピック
+# 配列:       名前長, dtype 文字列長, 次元数, 名前, dtype, 形状, データ
+_MAGIC = b"HKFO"
+_HEADER = struct.Struct("<4sHHqq")
+_ARRAY = struct.Struct("<HBB")
+_LENGTH = struct.Struct("<I")
+
+
+def encode(topic, frame, t_ns, arrays):
+    '''{名前: 配列} をトピック・フレーム番号・時刻とともにバイト列に変換する。'''
+    topic = topic.encode("utf-8")
+    parts = [_HEADER.pack(_MAGIC, len(topic), len(arrays), frame, t_ns),
+             topic]
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        name = name.encode("utf-8")
+        dtype = a.dtype.str.encode("ascii")
+        parts.append(_ARRAY.pack(len(name), len(dtype), a.ndim))
+        parts.append(name)
+        parts.append(dtype)
+        parts.append(struct.pack("<{}q".format(a.ndim), *a.shape))
+        parts.append(a.data)
+    body = b"".join(parts)
+    return _LENGTH.pack(len(body)) + body
+
+
+def decode(body):
+    '''encode() のバイト列（長さを除いた部分）を
+    (トピック, フレーム番号, 時刻, {名前: 配列}) に戻す。
+    配列はコピーせず body を参照する。
+    '''
+    body = memoryview(body)
+    magic, ntopic, narrays, frame, t_ns = _HEADER.unpack_from(body, 0)
+    if magic != _MAGIC:
+        raise ValueError("bad message magic: " + repr(magic))
+    offset = _HEADER.size
+    topic = bytes(body[offset:offset + ntopic]).decode("utf-8")
+    offset += ntopic
+    arrays = {}
+    for _ in range(narrays):
+        nname, ndtype, ndim = _ARRAY.unpack_from(body, offset)
+        offset += _ARRAY.size
+        name = bytes(body[offset:offset + nname]).decode("utf-8")
+        offset += nname
+        dtype = np.dtype(bytes(body[offset:offset + ndtype]).decode("ascii"))
+        offset += ndtype
+        shape = struct.unpack_from("<{}q".format(ndim), body, offset)
+        offset += 8 * ndim
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(body, dtype=dtype, count=count,
+                                     offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return topic, frame, t_ns, arrays
+
+
+def _get(src, key):
+    if isinstance(src, dict):
+        return src[key]
+    return getattr(src, key)
+
+
+def from_sources(sources):
+    '''音源情報（リストまたは {ID: 音源} の辞書）を配列にまとめる。'''
+    sources = list(sources.values()) if isinstance(sources, dict) \
+        else list(sources)
+    return {
+        "id": np.array([_get(s, "id") for s in sources], dtype=np.int32),
+        "x": np.array([_get(s, "x") for s in sources],
+                      dtype=np.float32).reshape(-1, 3),
+        "power": np.array([_get(s, "power") for s in sources],
+                          dtype=np.float32),
+    }
+
+
+def from_dict(data):
+    '''{音源ID: 配列}（分離音のスペクトルや特徴量）を
+    音源IDの配列と、音源IDの順に積み重ねた配列にまとめる。
+    '''
+    ids = sorted(data.keys())
+    out = {"id": np.array(ids, dtype=np.int32)}
+    if ids:
+        out["data"] = np.stack([np.asarray(data[k]) for k in ids])
+    return out
+
+
+class _Consumer:
+    '''接続中の利用者1つ分の送信キューと送信スレッド。'''
+
+    def __init__(self, sock, topics, max_messages):
+        self.sock = sock
+        self.topics = topics
+        self.dropped = 0
+        self.sent = 0
+        self.alive = True
+        self._queue = collections.deque(maxlen=max_messages)
+        self._ready = threading.Event()
+        threading.Thread(target=self._sender, daemon=True).start()
+
+    def offer(self, message):
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(message)
+        self._ready.set()
+
+    def _sender(self):
+        try:
+            while self.alive:
+                self._ready.wait()
+                self._ready.clear()
+                while self._queue:
+                    self.sock.sendall(self._queue.popleft())
+                    self.sent += 1
+        except OSError:
+            pass
+        self.alive = False
+        self.sock.close()
+
+    def close(self):
+        self.alive = False
+        self._ready.set()
+
+
+class FanoutPublisher:
+    '''Unixドメインソケット path で利用者の接続を受け付け、
+    publish() されたメッセージを購読中の利用者に配信する。
+    '''
+
+    def __init__(self, path, max_messages=256, handshake_timeout=5.0):
+        self.path = path
+        self.max_messages = max_messages
+        self.handshake_timeout = handshake_timeout
+        self.consumers = []
+        self._dropped_closed = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                break
+            # 何も送らない利用者が他の接続を妨げないよう、
+            # 購読の受け付けは接続ごとのスレッドで行う
+            threading.Thread(target=self._handshake, args=(sock,),
+                             daemon=True).start()
+
+    def _handshake(self, sock):
+        # 最初の1行で購読するトピックを受け取る（例: "SUB sources,features"）
+        try:
+            sock.settimeout(self.handshake_timeout)
+            with sock.makefile("rb") as f:
+                line = f.readline().decode("utf-8").split()
+            sock.settimeout(None)
+        except (OSError, UnicodeDecodeError):
+            line = None
+        if not line or len(line) != 2 or line[0] != "SUB":
+            sock.close()
+            return
+        consumer = _Consumer(sock, set(line[1].split(",")), self.max_messages)
+        with self._lock:
+            # 切断した利用者を除くときは、捨てたメッセージ数を累計に移す
+            alive = []
+            for c in self.consumers:
+                if c.alive:
+                    alive.append(c)
+                else:
+                    self._dropped_closed += c.dropped
+            self.consumers = alive + [consumer]
+
+    @property
+    def dropped(self):
+        '''切断した利用者の分も含めた、捨てたメッセージ数の累計。'''
+        with self._lock:
+            return self._dropped_closed + sum(c.dropped
+                                              for c in self.consumers)
+
+    def publish(self, topic, frame, t_ns, arrays):
+        '''メッセージを1回だけ変換し、購読中の利用者のキューに入れる。
+        待つことはないので SubscribeData のコールバックから呼んでよい。
+        '''
+        consumers = [c for c in self.consumers
+                     if c.alive and (topic in c.topics or "*" in c.topics)]
+        if not consumers:
+            return
+        message = encode(topic, frame, t_ns, arrays)
+        for c in consumers:
+            c.offer(message)
+
+    def close(self):
+        self._sock.close()
+        for c in self.consumers:
+            c.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class FanoutSubscriber:
+    '''FanoutPublisher に接続し、topics のメッセージを受け取る。
+    "*" を与えるとすべてのトピックを受け取る。
+    '''
+
+    def __init__(self, path, topics):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._sock.sendall("SUB {}\n".format(",".join(topics)).encode("utf-8"))
+
+    def _recv_exact(self, n):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        while n > 0:
+            k = self._sock.recv_into(view[-n:], n)
+            if k == 0:
+                return None
+            n -= k
+        return buf
+
+    def recv(self):
+        '''次のメッセージを (トピック, フレーム番号, 時刻, {名前: 配列}) で返す。
+        接続が切れた場合は None を返す。
+        '''
+        head = self._recv_exact(_LENGTH.size)
+        if head is None:
+            return None
+        body = self._recv_exact(_LENGTH.unpack(head)[0])
+        if body is None:
+            return None
+        return decode(body)
+
+    def __iter__(self):
+        while True:
+            message = self.recv()
+            if message is None:
+                break
+            yield message
+
+    def close(self):
+        self._sock.close()
+
+# end of file
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+'''音声認識用の特徴量抽出をまとめて行うバッチ型エンジン。
+HARK_Recognition の
+WhiteNoiseAdder → PreEmphasis → MelFilterBank → MSLSExtraction → Delta
+→ FeatureRemover → SpectralMeanNormalizationIncremental
+の連鎖を、全音源・全フレームをまとめた配列に対する NumPy の演算で計算する。
+メルフィルタバンクと、対数メルスペクトルから MSLS への変換
+（DCT・リフタリング・逆DCT）は行列として事前に計算しておく。
+
+入力は stft_engine.pack_sources でまとめた分離音のスペクトル
+(フレーム数, 音源数, 周波数ビン数) で、出力は FeatureRemover で
+SELECTOR の次元を取り除いた後の (フレーム数, 音源数, 次元数) の特徴量である。
+Delta と SpectralMeanNormalizationIncremental は音源ごとの
+連続した区間（音源が存在するフレームの並び）の中で計算する。
+
+引数としてWAVファイルを与えて実行すると、ノードの連鎖との比較を表示する。
+'''
+
+import sys
+import time
+
+import numpy as np
+
+from stft_engine import pack_sources
+
+
+def mel(f):
+    return 1127.0 * np.log(1.0 + f / 700.0)
+
+
+def mel_filter_bank(fbank_count=40, length=512, sampling_rate=16000,
+                    min_frequency=63, max_frequency=8000):
+    '''三角窓のメルフィルタバンクを (fbank_count, 周波数ビン数) の行列で返す。
+    各フィルタの中心はメル尺度上で等間隔に並べる。
+    '''
+    nbin = length // 2 + 1
+    freqs = mel(np.arange(nbin) * sampling_rate / length)
+    points = np.linspace(mel(min_frequency), mel(max_frequency),
+                         fbank_count + 2)
+    lo, center, hi = points[:-2, None], points[1:-1, None], points[2:, None]
+    up = (freqs - lo) / (center - lo)
+    down = (hi - freqs) / (hi - center)
+    return np.maximum(0.0, np.minimum(up, down)).astype(np.float32)
+
+
+def msls_matrix(fbank_count=40, lifter=22, normalization_mode="SPECTRAL"):
+    '''対数メルスペクトルを MSLS に変換する (fbank_count, fbank_count) の行列を返す。
+    直交DCTでケプストラムに変換し、リフタリングしたのち逆DCTで戻す。
+    NORMALIZATION_MODE が "SPECTRAL" の場合は0次のケプストラム
+    （全チャネルの平均）を取り除く。
+    '''
+    if normalization_mode not in ("SPECTRAL", "CEPSTRAL"):
+        raise ValueError("unknown NORMALIZATION_MODE: "
+                         + repr(normalization_mode))
+    n = np.arange(fbank_count)
+    dct = np.cos(np.pi * n[:, None] * (n[None, :] + 0.5) / fbank_count)
+    dct *= np.sqrt(2.0 / fbank_count)
+    dct[0] /= np.sqrt(2.0)
+    weight = np.ones(fbank_count)
+    if lifter > 0:
+        weight = 1.0 + 0.5 * lifter * np.sin(np.pi * n / lifter)
+    if normalization_mode == "SPECTRAL":
+        weight[0] = 0.0
+    # 行ベクトルに右から掛ける形にしておく
+    return (dct.T @ (weight[:, None] * dct)).T.astype(np.float32)
+
+
+def segments(active):
+    '''(フレーム数, 音源数) の有無から、各フレームが属する区間の
+    先頭と末尾のフレーム番号を返す。
+    '''
+    nframes = active.shape[0]
+    t = np.arange(nframes)[:, None]
+    prev = np.zeros_like(active)
+    prev[1:] = active[:-1]
+    nxt = np.zeros_like(active)
+    nxt[:-1] = active[1:]
+    first = np.maximum.accumulate(
+        np.where(active & ~prev, t, 0), axis=0)
+    last = np.minimum.accumulate(
+        np.where(active & ~nxt, t, nframes - 1)[::-1], axis=0)[::-1]
+    return first, last
+
+
+def _gather(x, index):
+    return np.take_along_axis(x, index[:, :, None], axis=0)
+
+
+class BatchFeatures:
+    '''HARK_Recognition の特徴量抽出と同等の処理をバッチで行うエンジン。
+    パラメータの意味と既定値は各ノードに合わせている。
+    selector には FeatureRemover と同じく「取り除く」次元を与える。
+    '''
+
+    def __init__(self,
+                 fbank_count=40,
+                 length=512,
+                 sampling_rate=16000,
+                 min_frequency=63,
+                 max_frequency=8000,
+                 wn_level=15,
+                 preemcoef=0.97,
+                 normalization_mode="SPECTRAL",
+                 use_power=True,
+                 lifter=22,
+                 delta_window=2,
+                 selector=range(40, 81+1),
+                 floor=1e-10,
+                 chunk_frames=1024,
+                 seed=None):
+        self.fbank_count = fbank_count
+        self.nbin = length // 2 + 1
+        self.wn_level = wn_level
+        self.use_power = use_power
+        self.delta_window = delta_window
+        self.floor = floor
+        self.chunk_frames = chunk_frames
+        self.rng = np.random.default_rng(seed)
+
+        self.fbank = mel_filter_bank(fbank_count, length, sampling_rate,
+                                     min_frequency, max_frequency)
+        self.msls = msls_matrix(fbank_count, lifter, normalization_mode)
+
+        # PreEmphasis（1 - c z^-1）の周波数応答
+        omega = 2.0 * np.pi * np.arange(self.nbin) / length
+        self.preemphasis = (1.0 - preemcoef * np.exp(-1j * omega)) \
+            .astype(np.complex64)
+
+        # MSLSExtraction の出力は静的特徴量（＋パワー）と、
+        # Delta が埋める同じ次元数の差分特徴量からなる
+        self.nstatic = fbank_count + (1 if use_power else 0)
+        removed = {int(c) for c in selector}
+        self.keep = np.array([c for c in range(2 * self.nstatic)
+                              if c not in removed], dtype=np.intp)
+        self.ndim = len(self.keep)
+        # 差分特徴量をすべて取り除く場合は Delta の計算を省く
+        self._need_delta = bool(np.any(self.keep >= self.nstatic))
+
+    def static(self, spec):
+        '''(フレーム数, 音源数, 周波数ビン数) のスペクトルから
+        MSLS（とパワー）の静的特徴量を計算する。
+        '''
+        nframes, nsrc = spec.shape[0], spec.shape[1]
+        out = np.empty((nframes, nsrc, self.nstatic), dtype=np.float32)
+        for start in range(0, nframes, self.chunk_frames):
+            stop = min(start + self.chunk_frames, nframes)
+            x = spec[start:stop]
+            if self.wn_level > 0:
+                shape = x.shape
+                noise = self.rng.standard_normal(shape + (2,),
+                                                 dtype=np.float32)
+                x = x + self.wn_level * (noise[..., 0] + 1j * noise[..., 1])
+            x = x * self.preemphasis
+            power = x.real ** 2 + x.imag ** 2
+            logmel = np.log(np.maximum(power @ self.fbank.T, self.floor))
+            np.matmul(logmel, self.msls,
+                      out=out[start:stop, :, :self.fbank_count])
+            if self.use_power:
+                out[start:stop, :, -1] = np.log(
+                    np.maximum(power.sum(axis=-1), self.floor))
+        return out
+
+    def delta(self, x, first, last):
+        '''区間の端ではフレームを繰り返す回帰係数で差分特徴量を計算する。'''
+        nframes = x.shape[0]
+        t = np.arange(nframes)[:, None]
+        out = np.zeros_like(x)
+        for k in range(1, self.delta_window + 1):
+            out += k * (_gather(x, np.minimum(t + k, last))
+                        - _gather(x, np.maximum(t - k, first)))
+        out /= 2.0 * sum(k * k for k in range(1, self.delta_window + 1))
+        return out
+
+    def normalize(self, x, first):
+        '''区間の先頭から各フレームまでの平均を差し引く。'''
+        nframes = x.shape[0]
+        cs = np.zeros((nframes + 1,) + x.shape[1:], dtype=np.float64)
+        np.cumsum(x, axis=0, out=cs[1:])
+        t = np.arange(nframes)[:, None]
+        count = (t - first + 1)[:, :, None]
+        mean = (cs[1:] - _gather(cs, first)) / count
+        return (x - mean).astype(np.float32)
+
+    def extract(self, spec, active=None):
+        '''(フレーム数, 音源数, 周波数ビン数) のスペクトルから
+        (フレーム数, 音源数, 次元数) の特徴量を計算する。
+        active は音源が存在するフレームを表す (フレーム数, 音源数) の
+        真偽値の配列で、省略した場合は 0 でないスペクトルを存在とみなす。
+        存在しないフレームの特徴量は 0 とする。
+        '''
+        if active is None:
+            active = np.any(spec != 0, axis=-1)
+        first, last = segments(active)
+        static = self.static(spec)
+        if self._need_delta:
+            feats = np.concatenate(
+                [static, self.delta(static, first, last)], axis=-1)
+        else:
+            feats = static
+        feats = feats[:, :, self.keep]
+        feats[~active] = 0.0
+        out = self.normalize(feats, first)
+        out[~active] = 0.0
+        return out
+
+    def extract_sources(self, outputs):
+        '''GHDSS の出力（フレームごとの {音源ID: スペクトル} の辞書のリスト）から
+        SpectralMeanNormalizationIncremental と同じ形式の
+        {音源ID: 特徴量} の辞書のリストを返す。
+        '''
+        ids, spec = pack_sources(outputs, self.nbin)
+        active = np.zeros(spec.shape[:2], dtype=bool)
+        index = {k: i for i, k in enumerate(ids)}
+        for t, g in enumerate(outputs):
+            for k in g.keys():
+                active[t, index[k]] = True
+        feats = self.extract(spec, active)
+        return [{k: feats[t, index[k]] for k in g.keys()}
+                for t, g in enumerate(outputs)]
+
+
+def main():
+    '''ノードの連鎖とバッチ型エンジンの特徴量・処理時間を比較する。
+    乱数による違いを除くため、どちらも WN_LEVEL=0 で計算する。
+    '''
+
+    import soundfile as sf
+
+    import hark
+
+    from stft_engine import BatchSTFT
+
+    if len(sys.argv) < 2:
+        print("no input file")
+        return
+    wavfilename = sys.argv[1]
+
+    audio, rate = sf.read(wavfilename, dtype=np.int16)
+    spec = BatchSTFT(sampling_rate=rate, scale=1.0/32768).stft(audio)
+    # 各チャネルを音源とみなし、音源の有無が変わる区間も作る
+    outputs = [{c: s[c] for c in range(s.shape[0])
+                if c % 2 == 0 or (t // 200) % 2 == 0}
+               for t, s in enumerate(spec)]
+    selector = " ".join([str(c) for c in range(40, 81+1)])
+
+    t0 = time.perf_counter()
+    x = hark.node.WhiteNoiseAdder()(INPUT=outputs, WN_LEVEL=0).OUTPUT
+    x = hark.node.PreEmphasis()(INPUT=x, INPUT_TYPE="SPECTRUM").OUTPUT
+    fbank = hark.node.MelFilterBank()(INPUT=x, FBANK_COUNT=40).OUTPUT
+    x = hark.node.MSLSExtraction()(
+        FBANK=fbank, SPECTRUM=x, FBANK_COUNT=40,
+        NORMALIZATION_MODE="SPECTRAL", USE_POWER=True).OUTPUT
+    x = hark.node.Delta()(INPUT=x).OUTPUT
+    x = hark.node.FeatureRemover()(INPUT=x, SELECTOR=selector).OUTPUT
+    ref = hark.node.SpectralMeanNormalizationIncremental()(
+        INPUT=x, NOT_EOF=True, SM_HISTORY=False, PERIOD=1).OUTPUT
+    t1 = time.perf_counter()
+    engine = BatchFeatures(wn_level=0)
+    feats = engine.extract_sources(outputs)
+    t2 = time.perf_counter()
+
+    diff = max((np.max(np.abs(np.asarray(r[k]) - f[k]))
+                for r, f in zip(ref, feats) for k in r.keys()), default=0.0)
+    scale = max((np.max(np.abs(np.asarray(r[k])))
+                 for r in ref for k in r.keys()), default=1.0)
+    print("dimensions: chain={} batch={}".format(
+        len(next(iter(ref[0].values()))), engine.ndim))
+    print("chain={:.3f}s batch={:.3f}s speedup={:.1f}x "
+          "max relative error={:.2e}".format(
+              t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), diff / scale))
+
+
+if __name__ == '__main__':
+    main()
+
+# end of file
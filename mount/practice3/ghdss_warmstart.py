@@ -0,0 +1,115 @@
+'''GHDSS の分離行列を実行をまたいで引き継ぐためのモジュール。
+GHDSS は毎回、分離行列を初期値から学習し直すため、
+ファイルの先頭や再起動の直後はしばらく分離性能が低い。
+アレイは固定設置なので、実行の終わりに GHDSS が書き出した分離行列
+（EXPORT_W / EXPORT_W_FILENAME）を保存し、次の実行では
+INITW_FILENAME として初期値に与える。
+保存した分離行列は、伝達関数ファイルの内容とアレイの構成から作るキーで区別する。
+分離行列のファイルは zip 形式なので、zip として読めないファイル
+（GHDSS が書き込み中のものなど）は保存しない。
+'''
+
+import hashlib
+import os
+import shutil
+import zipfile
+
+
+def complete(filename):
+    '''filename が存在し、zip として最後まで読めれば True を返す。'''
+    try:
+        with zipfile.ZipFile(filename) as zf:
+            return zf.testzip() is None
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+class WarmStartStore:
+    '''分離行列のスナップショットを directory に保存・読み込みするクラス。
+
+        store = WarmStartStore()
+        key = store.key("tf.zip", nch=8)
+        initw = store.initial(key)         # 無ければ None
+        export = store.export(key)         # この実行で書き出す先
+        ...                                # ネットワークを実行
+        store.commit(key)                  # 書き出された分離行列を保存
+    '''
+
+    def __init__(self, directory="ghdss_snapshots"):
+        self.directory = directory
+        self._keys = {}
+
+    def key(self, tf_filename, nch=8, sampling_rate=16000, length=512):
+        '''伝達関数ファイルの内容とアレイの構成からキーを作る。'''
+        setup = (tf_filename, nch, sampling_rate, length)
+        if setup not in self._keys:
+            with open(tf_filename, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()[:12]
+            self._keys[setup] = "{}_{}ch_{}hz_{}".format(
+                digest, nch, sampling_rate, length)
+        return self._keys[setup]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".zip")
+
+    def initial(self, key):
+        '''key の分離行列が保存されていればそのパスを、無ければ None を返す。'''
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def export(self, key, pid=None):
+        '''この実行で GHDSS が分離行列を書き出す一時ファイルのパスを返す。
+        同じキーで複数のプロセスが同時に実行しても衝突しないよう、
+        プロセスID（省略時は自身のもの）を含める。
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        if pid is None:
+            pid = os.getpid()
+        return os.path.join(self.directory, "{}.{}.tmp.zip".format(key, pid))
+
+    def capture_path(self, key):
+        return os.path.join(self.directory, key + ".capture.zip")
+
+    def capture(self, key):
+        '''実行中に GHDSS が書き出した分離行列を capture_path(key) にコピーし、
+        そのパスを返す（チェックポイント用）。まだ書き出されていない場合と、
+        コピーが zip として読めない場合は None を返す。
+        GHDSS が書き込んでいない間（そのネットワークの出力を受け取った時点など）に
+        分離行列を書き出すプロセス自身が呼ぶ。
+        '''
+        exported = self.export(key)
+        dst = self.capture_path(key)
+        tmp = "{}.{}.tmp".format(dst, os.getpid())
+        try:
+            shutil.copyfile(exported, tmp)
+        except OSError:
+            return None
+        if not complete(tmp):
+            os.remove(tmp)
+            return None
+        os.replace(tmp, dst)
+        return dst
+
+    def commit(self, key):
+        '''書き出された分離行列を key のスナップショットとして保存する。
+        置き換えは os.replace で行うため、読み込み中の他の実行が
+        書きかけのファイルを読むことはない。保存した場合は True を返す。
+        '''
+        exported = self.export(key)
+        if not os.path.exists(exported):
+            return False
+        if not complete(exported):
+            os.remove(exported)
+            return False
+        os.replace(exported, self.path(key))
+        return True
+
+    def restore(self, key, filename):
+        '''filename の分離行列（チェックポイントに保存したものなど）を
+        key のスナップショットとして置き、次に構築する GHDSS の初期値にする。
+        '''
+        tmp = self.export(key)
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, self.path(key))
+
+# end of file
@@ -0,0 +1,133 @@
+'''HARK形式の伝達関数ファイル（tf.zip）を読み込むモジュール。
+LocalizeMUSIC の A_MATRIX や GHDSS の TF_CONJ_FILENAME に与えている
+zip ファイルを展開し、音源位置・マイク位置・近傍情報と、
+定位用・分離用の伝達関数（ステアリングベクトル）を NumPy 配列として返す。
+'''
+
+import re
+import struct
+import xml.etree.ElementTree as ET
+import zipfile
+
+import numpy as np
+
+
+# HARK1.3 形式の行列ファイルのヘッダ（マジック文字列と型名は各32バイト）
+_MAGIC_SIZE = 32
+_TYPE_SIZE = 32
+_DTYPES = {
+    "complex": np.complex64,
+    "float": np.float32,
+}
+
+
+class TransferFunction:
+    '''tf.zip の内容を保持するクラス。
+
+    positions:     音源位置 (方向数, 3)
+    mic_positions: マイク位置 (チャネル数, 3)
+    neighbors:     方向ごとの近傍方向のインデックスのリスト
+    localization:  定位用伝達関数 (方向数, チャネル数, 周波数ビン数)
+    separation:    分離用伝達関数 (方向数, チャネル数, 周波数ビン数)
+    '''
+
+    def __init__(self, positions, mic_positions, neighbors,
+                 localization, separation, nfft, sampling_rate):
+        self.positions = positions
+        self.mic_positions = mic_positions
+        self.neighbors = neighbors
+        self.localization = localization
+        self.separation = separation
+        self.nfft = nfft
+        self.sampling_rate = sampling_rate
+
+    @property
+    def ndir(self):
+        return self.positions.shape[0]
+
+    @property
+    def nch(self):
+        return self.mic_positions.shape[0]
+
+    @property
+    def nbytes(self):
+        '''保持している伝達関数のバイト数。'''
+        n = 0
+        for a in (self.localization, self.separation):
+            if a is not None:
+                n += a.nbytes
+        return n
+
+
+def read_matrix(data):
+    '''HARK1.3 形式の行列ファイルのバイト列を NumPy 配列に変換する。'''
+    magic = data[:_MAGIC_SIZE].decode("ascii").strip()
+    if not magic.startswith("HARK"):
+        raise ValueError("not a HARK matrix file: " + repr(magic))
+    typename = data[_MAGIC_SIZE:_MAGIC_SIZE + _TYPE_SIZE].decode("ascii").strip()
+    if typename not in _DTYPES:
+        raise ValueError("unsupported matrix type: " + repr(typename))
+    offset = _MAGIC_SIZE + _TYPE_SIZE
+    (ndim,) = struct.unpack_from("<i", data, offset)
+    offset += 4
+    shape = struct.unpack_from("<" + "i" * ndim, data, offset)
+    offset += 4 * ndim
+    return np.frombuffer(data, dtype=_DTYPES[typename],
+                         count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+def _read_positions(root):
+    pos = root.find("positions")
+    items = sorted(((int(p.get("id")),
+                     [float(p.get("x")), float(p.get("y")), float(p.get("z"))])
+                    for p in pos.findall("position")))
+    return [i for i, _ in items], np.array([x for _, x in items],
+                                           dtype=np.float32)
+
+
+def _read_tfs(zf, names, subdir, index):
+    pattern = re.compile(r".*/" + subdir + r"/tf(\d+)\.mat$")
+    found = {}
+    for name in names:
+        m = pattern.match(name)
+        if m is not None:
+            found[int(m.group(1))] = name
+    if not found:
+        return None
+    return np.stack([read_matrix(zf.read(found[i])) for i in index])
+
+
+def load_tf(filename, localization=True, separation=True):
+    '''tf.zip を読み込み TransferFunction を返す。
+    localization / separation に False を与えると該当する伝達関数を読み込まない。
+    '''
+    with zipfile.ZipFile(filename) as zf:
+        names = zf.namelist()
+        source_xml = next(n for n in names if n.endswith("/source.xml"))
+        mic_xml = next(n for n in names if n.endswith("/microphones.xml"))
+
+        root = ET.fromstring(zf.read(source_xml))
+        ids, positions = _read_positions(root)
+        _, mic_positions = _read_positions(ET.fromstring(zf.read(mic_xml)))
+
+        config = root.find("config")
+        nfft = int(config.findtext("nfft", "512"))
+        sampling_rate = int(config.findtext("samplingRate", "16000"))
+
+        # 近傍情報は音源IDで書かれているので配列のインデックスに直す
+        index = {i: n for n, i in enumerate(ids)}
+        neighbors = [[n] for n in range(len(ids))]
+        node = root.find("neighbors")
+        if node is not None:
+            for nb in node.findall("neighbor"):
+                n = index[int(nb.get("id"))]
+                neighbors[n] = [index[int(i)]
+                                for i in nb.get("ids").split(";") if i]
+
+        loc = _read_tfs(zf, names, "localization", ids) if localization else None
+        sep = _read_tfs(zf, names, "separation", ids) if separation else None
+
+    return TransferFunction(positions, mic_positions, neighbors,
+                            loc, sep, nfft, sampling_rate)
+
+# end of file
@@ -0,0 +1,116 @@
+'''音響特徴量を Kaldi のバイナリ ark ファイルと scp 索引に書き出すモジュール。
+SourceTracker が出力する音源の区間を発話の区切りとし、
+音源ごと・発話ごとの特徴量を (フレーム数, 次元数) の float32 行列として保存する。
+書き出したファイルは HARK を動かさずに Kaldi のデコーダから読み込めるので、
+scp を分割すれば複数のマシンで並列にデコードできる。
+'''
+
+import os
+import struct
+
+import numpy as np
+
+
+def _ids(sources):
+    '''1フレーム分の音源情報（リストまたは {ID: 音源} の辞書）から音源IDを返す。'''
+    if isinstance(sources, dict):
+        return list(sources.keys())
+    return [s["id"] if isinstance(s, dict) else s.id for s in sources]
+
+
+def utterances(features, sources, min_frames=1):
+    '''フレームごとの {音源ID: 特徴量} と SourceTracker の音源情報から、
+    音源IDが連続して存在する区間を1発話として
+    (音源ID, 先頭フレーム, (フレーム数, 次元数) の行列) を順に返す。
+    '''
+    current = {}
+    for t, (feats, srcs) in enumerate(zip(features, sources)):
+        ids = {k for k in _ids(srcs) if k in feats}
+        for k in sorted(set(current) - ids):
+            start, rows = current.pop(k)
+            if len(rows) >= min_frames:
+                yield k, start, np.stack(rows)
+        for k in sorted(ids):
+            current.setdefault(k, (t, []))[1].append(
+                np.asarray(feats[k], dtype=np.float32))
+    for k in sorted(current):
+        start, rows = current[k]
+        if len(rows) >= min_frames:
+            yield k, start, np.stack(rows)
+
+
+class ArkWriter:
+    '''行列を ark ファイルに追記し、scp に「キー ark のパス:オフセット」を書く。
+    書き込みは buffer_size バイトのバッファにためてまとめて行う。
+    scp は Kaldi のツールが前提とするキーの順に並べ替えて close() で書く。
+
+        with ArkWriter("feats/input.ark", "feats/input.scp") as writer:
+            writer.write("input_0001_0000120", matrix)
+    '''
+
+    def __init__(self, ark, scp=None, buffer_size=8 * 1024 * 1024):
+        if scp is None:
+            scp = os.path.splitext(ark)[0] + ".scp"
+        directory = os.path.dirname(ark)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ark = ark
+        self.scp = scp
+        self._ark = open(ark, "wb", buffering=buffer_size)
+        self._index = []
+
+    def write(self, key, matrix):
+        '''key の行列を書き込み、ark ファイル内のオフセットを返す。'''
+        matrix = np.ascontiguousarray(matrix, dtype="<f4")
+        if " " in key:
+            raise ValueError("key must not contain spaces: " + repr(key))
+        self._ark.write(key.encode("utf-8") + b" ")
+        offset = self._ark.tell()
+        rows, cols = matrix.shape
+        self._ark.write(b"\0BFM " + struct.pack("<bibi", 4, rows, 4, cols))
+        self._ark.write(matrix.data)
+        self._index.append((key, offset))
+        return offset
+
+    @property
+    def count(self):
+        return len(self._index)
+
+    def close(self):
+        if self._ark.closed:
+            return
+        self._ark.close()
+        with open(self.scp, "w") as f:
+            for key, offset in sorted(self._index):
+                f.write("{} {}:{}\n".format(key, self.ark, offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export(writer, name, features, sources, min_frames=1):
+    '''features の全発話を「name_音源ID_先頭フレーム」のキーで書き出し、
+    書き出した発話数を返す。
+    '''
+    count = 0
+    for k, start, matrix in utterances(features, sources, min_frames):
+        writer.write("{}_{:04d}_{:07d}".format(name, k, start), matrix)
+        count += 1
+    return count
+
+
+def read_matrix(ark, offset):
+    '''ark ファイルの offset から行列を1つ読み込む（確認用）。'''
+    with open(ark, "rb") as f:
+        f.seek(offset)
+        header = f.read(15)
+        if header[:5] != b"\0BFM ":
+            raise ValueError("not a binary float matrix: " + repr(header[:5]))
+        _, rows, _, cols = struct.unpack("<bibi", header[5:])
+        return np.fromfile(f, dtype="<f4", count=rows * cols) \
+            .reshape(rows, cols)
+
+# end of file
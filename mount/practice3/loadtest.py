@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+'''practice3-2r.py の HARK_Main を K 本同時に実行し、
+1台で何本の8chマイクロホンアレイを実時間で処理できるかを調べるプログラム。
+各ストリームは別プロセスで、収録済みの音響信号（または合成信号）を
+実時間と同じ間隔で publish する。
+K を増やしながら、ストリームごとの処理の遅れ・取りこぼしたフレーム数・
+CPU使用率・最大RSS・入力から出力までの遅延の分位点を記録し、
+すべてのストリームが遅延の上限を守れた最大の K を表示する。
+音声認識の送信先（localhost の --port）には受け取ったデータを捨てるだけの
+代理サーバを立てる。
+各ストリームは図示のノードを含まないネットワークを構築し、分離音と
+GHDSS の分離行列はストリームごとの一時ディレクトリに書き出して終了時に消す。
+'''
+
+import argparse
+import collections
+import importlib
+import multiprocessing as mp
+import os
+import queue
+import resource
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
+
+import hark
+
+from ghdss_warmstart import WarmStartStore
+
+
+ADVANCE = 160
+
+
+class _DiscardHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while self.request.recv(65536):
+            pass
+
+
+class StandInRecognitionServer(socketserver.ThreadingTCPServer):
+    '''SpeechRecognitionClient の接続を受け付け、送られた特徴量を捨てる。'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="localhost", port=5530):
+        super().__init__((host, port), _DiscardHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def load_frames(filename, channels, rate, seconds, seed=0):
+    '''ストリームに流す (フレーム数, チャネル数, ADVANCE) の int16 信号を用意する。
+    filename が None の場合は白色雑音に正弦波を重ねた合成信号を作る。
+    '''
+    if filename is not None:
+        audio, rate = sf.read(filename, dtype=np.int16)
+    else:
+        rng = np.random.default_rng(seed)
+        n = int(seconds * rate)
+        t = np.arange(n) / rate
+        tone = 3000 * np.sin(2 * np.pi * 1000 * t)[:, None]
+        audio = (rng.normal(0, 300, (n, channels)) + tone).astype(np.int16)
+    frames = sliding_window_view(audio, ADVANCE, axis=0)[::ADVANCE, :, :]
+    return np.ascontiguousarray(frames), rate
+
+
+def run_stream(index, args, start_at, results):
+    '''1本のストリームを実行するプロセスの本体。'''
+    module = importlib.import_module(args.network_module)
+    frames, rate = load_frames(args.input, args.channels, args.rate,
+                               args.duration, seed=index)
+    hop = ADVANCE / rate
+    nframes = int(args.duration / hop)
+
+    # 図示は行わず、書き出すファイルはこのストリームの一時ディレクトリに置く
+    workdir = tempfile.mkdtemp(prefix="loadtest{}_".format(index))
+    module.recognition_port = args.port
+    module.plot_sources = False
+    module.wave_basename = os.path.join(workdir, "sep_")
+    module.ghdss_snapshots = WarmStartStore(os.path.join(workdir, "ghdss"))
+
+    network = hark.Network.from_networkdef(module.HARK_Main, name="HARK_Main")
+    publisher = network.query_nodedef("Publisher")
+    subscriber = network.query_nodedef("Subscriber")
+
+    pushed_at = collections.deque()
+    latency = []
+    count = [0]
+
+    def received(data):
+        count[0] += 1
+        if pushed_at:
+            latency.append(time.monotonic() - pushed_at.popleft())
+
+    subscriber.receive = received
+
+    th = threading.Thread(target=network.execute)
+    th.start()
+
+    # 全ストリームが同時に始まるように待つ
+    time.sleep(max(0.0, start_at - time.time()))
+    lateness = []
+    dropped = 0
+    pushed = 0
+    baseline = None
+    wall0 = time.monotonic()
+    usage0 = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        for t in range(nframes):
+            if not th.is_alive():
+                break
+            due = wall0 + t * hop
+            now = time.monotonic()
+            if now < due:
+                time.sleep(due - now)
+                now = time.monotonic()
+            # push() はキューに入れるだけなので、処理の遅れは
+            # 送信済みで出力が届いていないフレーム数（backlog）に現れる。
+            # LocalizeMUSIC などの先読みの分は遅れに含めないよう、
+            # 最初の出力が届いた時点の backlog を基準にする
+            backlog = pushed - count[0]
+            if baseline is None and count[0] > 0:
+                baseline = backlog
+            excess = backlog - baseline if baseline is not None else 0
+            lateness.append(now - due + max(0, excess) * hop)
+            # 基準からの遅れがデバイスのバッファ（drop_after フレーム分）を
+            # 超えたフレームは実機では失われるので、送らずに数える
+            if excess > args.drop_after:
+                dropped += 1
+                continue
+            pushed_at.append(now)
+            publisher.push(frames[t % len(frames)])
+            pushed += 1
+
+    finally:
+        publisher.close()
+        network.stop()
+        th.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    wall = time.monotonic() - wall0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage.ru_utime - usage0.ru_utime) + (usage.ru_stime - usage0.ru_stime)
+    lat = np.array(latency) * 1e3 if latency else np.zeros(1)
+    results.put({
+        "index": index,
+        "frames": nframes,
+        "received": count[0],
+        "dropped": dropped,
+        "late_max_ms": float(np.max(lateness)) * 1e3 if lateness else 0.0,
+        "cpu": cpu / wall,
+        "rss_mb": usage.ru_maxrss / 1024.0,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "p99_ms": float(np.percentile(lat, 99)),
+    })
+
+
+def run_level(k, args):
+    '''K 本のストリームを同時に実行し、各ストリームの結果を返す。'''
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    start_at = time.time() + args.startup
+    processes = [ctx.Process(target=run_stream,
+                             args=(i, args, start_at, results))
+                 for i in range(k)]
+    for p in processes:
+        p.start()
+    # 異常終了したストリームがあっても待ち続けないよう時間を区切る
+    out = []
+    for _ in processes:
+        try:
+            out.append(results.get(timeout=args.startup + args.duration + 60))
+        except queue.Empty:
+            break
+    # 結果を返さなかったストリームは終了を待ち切らずに止める
+    deadline = time.monotonic() + 10
+    for p in processes:
+        p.join(timeout=max(0.0, deadline - time.monotonic()))
+    for p in processes:
+        if p.is_alive():
+            p.terminate()
+            p.join()
+    return sorted(out, key=lambda r: r["index"])
+
+
+def ramp(max_streams, step):
+    k = 1
+    while k <= max_streams:
+        yield k
+        k = k * 2 if step == 0 else k + step
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-i', '--input', metavar='FILENAME',
+        help='8ch recording to replay (synthetic signal if omitted)')
+    parser.add_argument(
+        '--network-module', default='practice3-2r',
+        help='module that defines HARK_Main')
+    parser.add_argument(
+        '-c', '--channels', type=int, default=8,
+        help='channels of the synthetic signal')
+    parser.add_argument(
+        '-r', '--rate', type=int, default=16000,
+        help='sampling rate of the synthetic signal')
+    parser.add_argument(
+        '--duration', type=float, default=30.0,
+        help='seconds each stream runs at every level')
+    parser.add_argument(
+        '--max-streams', type=int, default=16,
+        help='largest number of concurrent streams to try')
+    parser.add_argument(
+        '--step', type=int, default=0,
+        help='add STEP streams per level (0 doubles K each level)')
+    parser.add_argument(
+        '--budget-ms', type=float, default=500.0,
+        help='p99 end-to-end latency every stream must stay within')
+    parser.add_argument(
+        '--drop-after', type=int, default=10,
+        help='frames of output lag beyond the steady-state look-ahead '
+             'after which a frame counts as dropped (device buffer)')
+    parser.add_argument(
+        '--startup', type=float, default=5.0,
+        help='seconds allowed for every stream to build its network')
+    parser.add_argument(
+        '--port', type=int, default=5530,
+        help='port of the stand-in recognition server the streams send to')
+    args = parser.parse_args()
+
+    server = StandInRecognitionServer(port=args.port)
+
+    best = 0
+    print("{:>3} {:>8} {:>8} {:>8} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+        "K", "dropped", "late_ms", "cpu", "rss_mb",
+        "p50_ms", "p95_ms", "p99_ms", "result"))
+    try:
+        for k in ramp(args.max_streams, args.step):
+            out = run_level(k, args)
+            if not out:
+                print("{:>3} no stream finished".format(k))
+                break
+            ok = len(out) == k and all(
+                r["dropped"] == 0 and r["received"] > 0
+                and r["p99_ms"] <= args.budget_ms for r in out)
+            print("{:>3} {:>8} {:>8.1f} {:>8.0%} {:>6.0f} {:>8.1f} "
+                  "{:>8.1f} {:>8.1f} {:>8}".format(
+                      k,
+                      sum(r["dropped"] for r in out),
+                      max(r["late_max_ms"] for r in out),
+                      sum(r["cpu"] for r in out),
+                      sum(r["rss_mb"] for r in out),
+                      max(r["p50_ms"] for r in out),
+                      max(r["p95_ms"] for r in out),
+                      max(r["p99_ms"] for r in out),
+                      "ok" if ok else "FAIL"))
+            if not ok:
+                break
+            best = k
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print("max streams within {:.0f} ms p99 latency: {}".format(
+        args.budget_ms, best))
+
+
+if __name__ == '__main__':
+    main()
+
+# end of file
@@ -0,0 +1,239 @@
+'''実行中のパイプラインの状態を Prometheus のテキスト形式で公開するモジュール。
+音声処理の経路では整数の加算や代入しか行わず、ロックを取らない。
+集計（毎秒のレート計算など）と HTTP での応答は別スレッドで行うため、
+スクレイプが音声の入力やネットワークの実行を妨げることはない。
+
+使い方:
+
+    metrics = PipelineMetrics()
+    metrics.serve(8000)              # http://127.0.0.1:8000/metrics
+    metrics.frames_pushed.inc()      # publisher.push() ごと
+    metrics.frames_consumed.inc()    # subscriber.receive() ごと
+'''
+
+import collections
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + "}"
+
+
+class Counter:
+    '''単調増加するカウンタ。1つのスレッドからのみ inc() すること。
+    func を与えた場合は inc() の代わりにスクレイプ時に func() を評価する
+    （他のプロセスが共有メモリに書き込む値を公開する場合など）。
+    '''
+
+    kind = "counter"
+
+    def __init__(self, func=None):
+        self._value = 0
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func() if self.func is not None else self._value
+
+    def inc(self, n=1):
+        self._value += n
+
+    def samples(self, name):
+        yield name, self.value
+
+
+class Gauge:
+    '''任意の値をとるゲージ。func を与えた場合はスクレイプ時に評価する。'''
+
+    kind = "gauge"
+
+    def __init__(self, func=None):
+        self.value = 0.0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        yield name, self.func() if self.func is not None else self.value
+
+
+class Summary:
+    '''直近 window 個の観測値から分位点を求めるサマリ。
+    deque への追加のみを行うため、音声処理の経路から呼んでもよい。
+    '''
+
+    kind = "summary"
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=1024):
+        self._values = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self._values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        values = np.array(self._values)
+        if len(values) > 0:
+            for q, v in zip(self.quantiles,
+                            np.quantile(values, self.quantiles)):
+                yield name + '{{quantile="{}"}}'.format(q), v
+        yield name + "_sum", self.sum
+        yield name + "_count", self.count
+
+
+class Registry:
+    '''メトリクスを名前とラベルで管理し、テキスト形式に変換する。'''
+
+    def __init__(self, prefix="hark_"):
+        self.prefix = prefix
+        self._metrics = collections.OrderedDict()
+
+    def _add(self, cls, name, help, labels=None, **kwargs):
+        name = self.prefix + name
+        entry = self._metrics.setdefault(name, (cls.kind, help, {}))
+        key = _format_labels(labels)
+        if key not in entry[2]:
+            entry[2][key] = cls(**kwargs)
+        return entry[2][key]
+
+    def counter(self, name, help, labels=None, func=None):
+        return self._add(Counter, name, help, labels, func=func)
+
+    def gauge(self, name, help, labels=None, func=None):
+        return self._add(Gauge, name, help, labels, func=func)
+
+    def summary(self, name, help, labels=None, window=1024):
+        return self._add(Summary, name, help, labels, window=window)
+
+    def render(self):
+        lines = []
+        for name, (kind, help, children) in list(self._metrics.items()):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in list(children.items()):
+                for sample, value in metric.samples(name):
+                    # サマリの分位点ラベルとメトリクス自体のラベルをまとめる
+                    if labels and "{" in sample:
+                        sample = sample.replace("{", labels[:-1] + ",", 1)
+                    elif labels:
+                        sample += labels
+                    lines.append("{} {}".format(sample, float(value)))
+        return "\n".join(lines) + "\n"
+
+
+class PipelineMetrics:
+    '''practice3 のオンライン処理スクリプトで共通に使うメトリクス。
+
+    frames_pushed:   Publisher に送ったフレーム数
+    frames_consumed: Subscriber が受け取ったフレーム数
+    frames_dropped:  捨てたフレームの数（負荷制御で処理を省略したフレーム、
+                     録音ファイルに書き込めなかったブロックなど）
+    overruns:        sounddevice が報告した入力オーバーフローの回数
+    active_sources:  SourceTracker が追跡中の音源数
+    end_to_end_seconds: publisher.push() から subscriber.receive() までの時間
+
+    毎秒のレート・キューの長さ・実時間比は sample_interval ごとに
+    別スレッドで計算する。
+    '''
+
+    def __init__(self, advance=160, sampling_rate=16000, sample_interval=1.0,
+                 registry=None):
+        self.registry = registry if registry is not None else Registry()
+        self.hop = advance / sampling_rate
+        self.sample_interval = sample_interval
+
+        r = self.registry
+        self.frames_pushed = r.counter(
+            "frames_pushed_total", "Frames pushed into the network.")
+        self.frames_consumed = r.counter(
+            "frames_consumed_total", "Frames received from the network.")
+        self.frames_dropped = r.counter(
+            "frames_dropped_total",
+            "Input frames skipped by load shedding or not recorded.")
+        self.overruns = r.counter(
+            "input_overruns_total", "Input overflows reported by the device.")
+        self.active_sources = r.gauge(
+            "active_sources", "Sources currently tracked by SourceTracker.")
+        r.gauge("publisher_queue_depth",
+                "Frames pushed but not yet received.",
+                func=lambda: (self.frames_pushed.value
+                              - self.frames_consumed.value))
+        self.pushed_rate = r.gauge(
+            "frames_pushed_per_second", "Frames pushed per second.")
+        self.consumed_rate = r.gauge(
+            "frames_consumed_per_second", "Frames received per second.")
+        self.real_time_factor = r.gauge(
+            "real_time_factor",
+            "Wall time per second of audio received (>1 means falling behind).")
+
+        self.end_to_end_seconds = r.summary(
+            "end_to_end_seconds",
+            "Time from pushing a frame to receiving its network output.")
+
+        self._server = None
+        self._last = None
+
+    def _sample(self):
+        now = time.monotonic()
+        pushed = self.frames_pushed.value
+        consumed = self.frames_consumed.value
+        if self._last is not None:
+            t, p, c = self._last
+            dt = now - t
+            self.pushed_rate.set((pushed - p) / dt)
+            self.consumed_rate.set((consumed - c) / dt)
+            if consumed > c:
+                self.real_time_factor.set(dt / ((consumed - c) * self.hop))
+        self._last = (now, pushed, consumed)
+
+    def _sampler(self):
+        while self._server is not None:
+            self._sample()
+            time.sleep(self.sample_interval)
+
+    def serve(self, port, host="127.0.0.1"):
+        '''メトリクスを http://host:port/metrics で公開するスレッドを起動する。'''
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        threading.Thread(target=self._sampler, daemon=True).start()
+
+    def shutdown(self):
+        if self._server is not None:
+            server, self._server = self._server, None
+            server.shutdown()
+            server.server_close()
+
+# end of file
@@ -0,0 +1,765 @@
+#!/usr/bin/env python
+
+'''practice3-2r.py の HARK_Main を、サブネットワーク単位で
+複数のプロセスに分割して実行するプログラム。
+引数としてTAMAGOで収録した8ch音響信号を受け取り、
+
+  メインプロセス:        AudioStreamFromMemory, MultiFFT
+  HARK_Localization:     音源定位・音源追跡
+  HARK_Separation:       GHDSSによる音源分離
+  HARK_Recognition:      特徴量抽出・Kaldiへの送信
+
+をそれぞれ別のプロセスで実行する。
+プロセス間はスペクトルと音源情報を共有メモリ上のリングバッファ
+（ringbuffer.SharedRingBuffer）で受け渡し、pickle は行わない。
+各フレームにはフレーム番号と入力時刻を付けて順序を確認し、
+最後のプロセスで入力から出力までの遅延を集計する。
+--shed-deadline-ms を与えると、出力の遅れに応じて
+shedding.LoadShedder が処理の質を段階的に下げ、追いつくと元に戻す。
+--checkpoint を与えると処理済みの位置・音源IDの状態・分離行列を定期的に保存し、
+異常終了した場合は次の実行でその位置から再開する。
+'''
+
+import argparse
+import collections
+import importlib
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+from numpy.lib.stride_tricks import sliding_window_view
+
+import hark
+
+from bufferpool import FRAME_SHAPES, BufferPool
+from checkpoint import Checkpointer
+from ghdss_warmstart import WarmStartStore
+from metrics import PipelineMetrics
+from ringbuffer import SharedRingBuffer
+from shedding import DEFAULT_LEVELS, LoadShedder
+import tfbank
+
+
+# サブネットワークの定義を読み込むモジュール
+NETWORK_MODULE = "practice3-2r"
+
+NCH = 8
+NBIN = 257
+ADVANCE = 160
+MAX_SOURCES = 8
+
+# ステージごとに共有する統計値:
+# [処理フレーム数, 処理時間の合計, 最新の出力の要素数,
+#  負荷制御で処理を省略したフレーム数, 最後に出力したフレーム番号]
+STAGE_STATS = 5
+
+# 音源追跡の状態を共有する配列: [次の音源ID, 音源数, (ID, x, y, z) * MAX_SOURCES]
+TRACKER_FIELDS = 2 + 4 * MAX_SOURCES
+
+# 再開時に、再開位置より前から入力し直すフレーム数
+# （LocalizeMUSIC の WINDOW に合わせ、空間相関行列を元の状態に戻す）
+RESUME_WARMUP = 50
+# 再開位置の前後でこの範囲内に現れた音源は、方向が近ければ以前のIDを引き継ぐ
+RESUME_MATCH_COS = np.cos(np.radians(10.0))
+
+# リングバッファの各スロットの形式
+SPEC_FIELDS = {
+    "spec": ((NCH, NBIN), np.complex64),
+}
+SOURCE_FIELDS = {
+    "count": ((1,), np.int32),
+    "id": ((MAX_SOURCES,), np.int32),
+    "x": ((MAX_SOURCES, 3), np.float32),
+    "power": ((MAX_SOURCES,), np.float32),
+}
+SEPARATED_FIELDS = {
+    "count": ((1,), np.int32),
+    "id": ((MAX_SOURCES,), np.int32),
+    "spec": ((MAX_SOURCES, NBIN), np.complex64),
+}
+
+# サブネットワークごとの入力名と出力名
+STAGES = {
+    "HARK_Localization": (("INPUT",), "OUTPUT"),
+    "HARK_Separation": (("SPEC", "SOURCES"), "SPECTRUM"),
+    "HARK_Recognition": (("INPUT", "SOURCES"), "OUTPUT"),
+}
+
+
+def _get(src, key):
+    if isinstance(src, dict):
+        return src[key]
+    return getattr(src, key)
+
+
+def decode_spec(slot, pool=None):
+    if pool is not None:
+        return pool.copy(slot["spec"])
+    return slot["spec"].copy()
+
+
+def encode_sources(data, slot):
+    '''音源情報（音源のリスト、または {ID: 音源} の辞書）をスロットに書き込む。
+    各音源は id・x・power をもつ辞書またはオブジェクトとする。
+    '''
+    sources = list(data.values()) if isinstance(data, dict) else list(data)
+    sources = sources[:MAX_SOURCES]
+    slot["count"][0] = len(sources)
+    for i, src in enumerate(sources):
+        slot["id"][i] = _get(src, "id")
+        slot["x"][i] = _get(src, "x")
+        slot["power"][i] = _get(src, "power")
+
+
+def decode_sources(slot):
+    n = int(slot["count"][0])
+    return [{"id": int(slot["id"][i]),
+             "x": slot["x"][i].tolist(),
+             "power": float(slot["power"][i])}
+            for i in range(n)]
+
+
+def encode_separated(data, slot):
+    '''分離音のスペクトル {音源ID: スペクトル} をスロットに書き込む。'''
+    items = list(data.items())[:MAX_SOURCES]
+    slot["count"][0] = len(items)
+    for i, (k, v) in enumerate(items):
+        slot["id"][i] = k
+        slot["spec"][i] = v
+
+
+def shed_sources(data, min_power):
+    '''パワーが min_power より小さい音源を取り除いた音源のリストを返す。'''
+    sources = list(data.values()) if isinstance(data, dict) else list(data)
+    return [s for s in sources if _get(s, "power") >= min_power]
+
+
+def decode_separated(slot):
+    n = int(slot["count"][0])
+    return {int(slot["id"][i]): slot["spec"][i].copy() for i in range(n)}
+
+
+class HARK_FrontEnd(hark.NetworkDef):
+    '''メインプロセスで実行するネットワーク。
+    入力として8ch音響信号を受け取り、フーリエ変換した結果を出力する。
+    '''
+
+    def build(self,
+              network: hark.Network,
+              input:   hark.DataSourceMap,
+              output:  hark.DataSinkMap):
+
+        node_publisher = network.create(
+            hark.node.PublishData,
+            dispatch=hark.RepeatDispatcher,
+            name="Publisher")
+        node_subscriber = network.create(
+            hark.node.SubscribeData,
+            name="Subscriber")
+        node_audio_stream_from_memory = network.create(
+            hark.node.AudioStreamFromMemory,
+            dispatch=hark.TriggeredMultiShotDispatcher)
+        node_multi_fft = network.create(hark.node.MultiFFT)
+
+        (
+            node_audio_stream_from_memory
+            .add_input("INPUT", node_publisher["OUTPUT"])
+            .add_input("CHANNEL_COUNT", NCH)
+        )
+        (
+            node_multi_fft
+            .add_input("INPUT", node_audio_stream_from_memory["AUDIO"])
+        )
+        (
+            node_subscriber
+            .add_input("INPUT", node_multi_fft["OUTPUT"])
+        )
+
+        r = [
+            node_publisher,
+            node_subscriber,
+            node_audio_stream_from_memory,
+            node_multi_fft,
+        ]
+        return r
+
+
+def stage_networkdef(subnetwork, inputs, output_name):
+    '''サブネットワークの各入力に Publisher を、出力に Subscriber を
+    接続したネットワークの定義を作成する。
+    '''
+
+    class HARK_Stage(hark.NetworkDef):
+
+        def build(self,
+                  network: hark.Network,
+                  input:   hark.DataSourceMap,
+                  output:  hark.DataSinkMap):
+
+            publishers = [
+                network.create(
+                    hark.node.PublishData,
+                    dispatch=hark.RepeatDispatcher,
+                    name="Publisher_" + name)
+                for name in inputs]
+            node_subscriber = network.create(
+                hark.node.SubscribeData,
+                name="Subscriber")
+            node_subnetwork = network.create(
+                subnetwork,
+                name=subnetwork.__name__)
+
+            for name, node_publisher in zip(inputs, publishers):
+                node_subnetwork.add_input(name, node_publisher["OUTPUT"])
+            (
+                node_subscriber
+                .add_input("INPUT", node_subnetwork[output_name])
+            )
+
+            return publishers + [node_subscriber, node_subnetwork]
+
+    return HARK_Stage
+
+
+def _read_all(inputs, th):
+    '''すべての入力リングから次のフレームを読み出す。
+    入力が終了した、またはネットワークが停止した場合は None を返す。
+    '''
+    items = []
+    for _, ring, reader, _ in inputs:
+        item = None
+        while item is None:
+            item = ring.read(reader, timeout=0.1)
+            if item is None and (ring.closed and ring.pending(reader) == 0
+                                 or not th.is_alive()):
+                return None
+        items.append(item)
+    return items
+
+
+def run_stage(stage, inputs, output, stats, shared, index, level=None,
+              tracker=None, resume=None, sampling_rate=16000,
+              wave_basename="sep_", snapshot=None):
+    '''サブネットワーク stage を実行するプロセスの本体。
+
+    inputs: (入力名, リングバッファ, 読み出し番号, デコーダ) のリスト
+    output: (リングバッファ, エンコーダ)。最後のプロセスでは None
+    stats:  処理結果の統計を親プロセスに返すキュー
+    shared: 実行中の統計値を親プロセスに公開する共有配列
+            （このプロセスは index 番目の STAGE_STATS 個の要素にのみ書き込む）
+    level:  LoadShedder が選んだ段階の番号を親プロセスから受け取る共有変数
+    tracker: 音源追跡の状態を親プロセスに公開する共有配列（TRACKER_FIELDS）
+    resume: チェックポイントから再開する場合の状態
+    sampling_rate: 入力のサンプリング周波数
+    wave_basename: 分離音を保存するファイル名の先頭
+    snapshot: 分離行列の保存の要求と応答を親プロセスと受け渡す共有配列
+              （[要求番号, 応答番号, 保存したフレーム番号（失敗した場合は -1）]）
+    '''
+    module = importlib.import_module(NETWORK_MODULE)
+    module.num_channels = NCH
+    module.sampling_rate = sampling_rate
+    module.wave_basename = wave_basename
+    if resume is not None:
+        module.source_min_id = resume["next_id"]
+    names, output_name = STAGES[stage]
+    networkdef = stage_networkdef(getattr(module, stage), names, output_name)
+    network = hark.Network.from_networkdef(networkdef, name=stage)
+
+    publishers = {name: network.query_nodedef("Publisher_" + name)
+                  for name in names}
+    subscriber = network.query_nodedef("Subscriber")
+
+    # 出力はフレーム順に届くので、入力したフレームの番号と時刻を順に対応付ける。
+    # ネットワークに入力しなかったフレーム（skipped）は直前の出力で埋める。
+    # 入力したスペクトルの配列はプールから取り出し、出力が届いたら返却する
+    pending = collections.deque()
+    spec_pool = BufferPool(*FRAME_SHAPES["spec"], size=256)
+    latency = []
+    lock = threading.Lock()
+    last = [{} if stage == "HARK_Separation" else []]
+
+    def current():
+        return DEFAULT_LEVELS[level.value if level is not None else 0]
+
+    # 再開後の音源IDを、チェックポイントの時点で存在した音源のIDに対応付ける
+    id_map = {}
+    unclaimed = list(resume["sources"]) if resume is not None else []
+
+    def remap(data, frame):
+        sources = list(data.values()) if isinstance(data, dict) else list(data)
+        out = []
+        for src in sources:
+            k = _get(src, "id")
+            x = np.asarray(_get(src, "x"), dtype=np.float64)
+            if k not in id_map:
+                id_map[k] = k
+                if unclaimed and frame < resume["frame"] + RESUME_WARMUP:
+                    u = np.array([s["x"] for s in unclaimed])
+                    cos = u @ x / np.maximum(
+                        np.linalg.norm(u, axis=1) * np.linalg.norm(x), 1e-12)
+                    best = int(np.argmax(cos))
+                    if cos[best] >= RESUME_MATCH_COS:
+                        id_map[k] = unclaimed.pop(best)["id"]
+            out.append({"id": id_map[k], "x": x.tolist(),
+                        "power": _get(src, "power")})
+        return out
+
+    def publish_tracker(data):
+        sources = list(data.values()) if isinstance(data, dict) else list(data)
+        ids = [_get(s, "id") for s in sources] + list(id_map)
+        n = min(len(sources), MAX_SOURCES)
+        with tracker.get_lock():
+            tracker[0] = max([tracker[0]] + [k + 1 for k in ids])
+            tracker[1] = n
+            for i, src in enumerate(sources[:n]):
+                tracker[2 + 4 * i] = _get(src, "id")
+                tracker[3 + 4 * i:6 + 4 * i] = list(_get(src, "x"))
+
+    def emit(frame, t_ns, pushed, data):
+        base = index * STAGE_STATS
+        shared[base] += 1
+        shared[base + 1] += time.monotonic() - pushed
+        shared[base + 2] = len(data)
+        shared[base + 4] = max(shared[base + 4], frame)
+        if output is None:
+            latency.append(time.monotonic_ns() - t_ns)
+            return
+        if stage == "HARK_Localization":
+            if resume is not None:
+                data = remap(data, frame)
+            if tracker is not None:
+                publish_tracker(data)
+            if current().min_power is not None:
+                data = shed_sources(data, current().min_power)
+        ring, encode = output
+        slot = ring.reserve()
+        encode(data, slot)
+        ring.commit(frame, t_ns)
+
+    def received(data):
+        with lock:
+            frame, t_ns, pushed, _, buffers = pending.popleft()
+            for a in buffers:
+                spec_pool.release(a)
+            last[0] = data
+            emit(frame, t_ns, pushed, data)
+            while pending and pending[0][3]:
+                frame, t_ns, pushed, _, _ = pending.popleft()
+                emit(frame, t_ns, pushed, data)
+        if snapshot is not None and snapshot[1] != snapshot[0]:
+            # 出力を受け取った時点では GHDSS は分離行列を書き込んでいないので、
+            # 書き出したファイルをチェックポイント用にコピーする
+            request = snapshot[0]
+            captured = module.ghdss_snapshots.capture(module.ghdss_key())
+            snapshot[2] = frame if captured is not None else -1
+            snapshot[1] = request
+
+    def skipped(frame, t_ns):
+        with lock:
+            if pending:
+                pending.append((frame, t_ns, time.monotonic(), True, ()))
+            else:
+                emit(frame, t_ns, time.monotonic(), last[0])
+
+    subscriber.receive = received
+
+    th = threading.Thread(target=network.execute)
+    th.start()
+
+    count = 0
+    t0 = time.monotonic()
+    try:
+        while True:
+            items = _read_all(inputs, th)
+            if items is None:
+                break
+            frames = {item[0] for item in items}
+            if len(frames) != 1:
+                raise RuntimeError("frame mismatch in {}: {}".format(
+                    stage, sorted(frames)))
+            frame, t_ns = items[0][:2]
+            shed = current()
+            # localize_every では LocalizeMUSIC にスペクトルを入力しない
+            # （shedding.py の注意を参照）
+            shedding = (stage == "HARK_Localization"
+                        and frame % shed.localize_every != 0
+                        or stage == "HARK_Recognition"
+                        and not shed.recognition)
+            if (shedding
+                    # 再開時に入力し直したフレームは二重に出力しない
+                    # （入力し直すのは定位の相関行列を戻すためで、
+                    # 分離は保存した分離行列から再開する）
+                    or stage in ("HARK_Separation", "HARK_Recognition")
+                    and resume is not None and frame < resume["frame"]):
+                if shedding:
+                    shared[index * STAGE_STATS + 3] += 1
+                for _, ring, reader, _ in inputs:
+                    ring.release(reader)
+                skipped(frame, t_ns)
+                count += 1
+                continue
+            data = {}
+            buffers = []
+            for (name, ring, reader, decode), (_, _, slot) in zip(inputs,
+                                                                   items):
+                if decode is decode_spec:
+                    data[name] = decode(slot, spec_pool)
+                    buffers.append(data[name])
+                else:
+                    data[name] = decode(slot)
+                ring.release(reader)
+            with lock:
+                pending.append((frame, t_ns, time.monotonic(), False,
+                                buffers))
+            for name, value in data.items():
+                publishers[name].push(value)
+            count += 1
+
+    finally:
+        # 以降は読み出さないので、上流のプロセスがこのプロセスを待たないようにする
+        for _, ring, reader, _ in inputs:
+            ring.leave(reader)
+        for publisher in publishers.values():
+            publisher.close()
+        network.stop()
+        th.join()
+        if stage == "HARK_Separation":
+            # 学習した分離行列を次の実行の初期値として保存する
+            module.ghdss_snapshots.commit(module.ghdss_key())
+        if output is not None:
+            output[0].close()
+        stats.put((stage, count, time.monotonic() - t0, latency,
+                   spec_pool.grown))
+
+
+def main():
+    '''各サブネットワークのプロセスを起動し、
+    コマンドライン引数で指定されたWAVファイルを読み込んで
+    メインプロセスのネットワークに逐次的に publish する。
+    '''
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'filename', metavar='FILENAME', help='input audio file')
+    parser.add_argument(
+        '--no-realtime', action='store_true',
+        help='push frames as fast as possible instead of 1x pacing')
+    parser.add_argument(
+        '--slots', type=int, default=256,
+        help='number of frames each ring buffer can hold')
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument(
+        '--shed-deadline-ms', type=float,
+        help='degrade processing when output lags input by more than this '
+             '(beyond the steady-state look-ahead of the stages)')
+    parser.add_argument(
+        '--checkpoint', metavar='FILENAME',
+        help='save progress to FILENAME and resume from it after a crash')
+    parser.add_argument(
+        '--checkpoint-interval', type=float, default=30.0,
+        help='seconds between checkpoints')
+    args = parser.parse_args()
+
+    # 同じ入力ファイルのチェックポイントがあれば、その位置から再開する
+    rate = sf.info(args.filename).samplerate
+    snapshots = WarmStartStore()
+    key = snapshots.key(tfbank.path(), nch=NCH, sampling_rate=rate)
+    source = os.path.abspath(args.filename)
+    checkpointer = None
+    resume = None
+    if args.checkpoint is not None:
+        checkpointer = Checkpointer(args.checkpoint)
+        state = checkpointer.load()
+        if state is not None and state.get("input") == source:
+            resume = state
+            if "ghdss" in state["files"]:
+                snapshots.restore(key, state["files"]["ghdss"])
+            print("resuming from frame {} (next source ID {})".format(
+                state["frame"], state["next_id"]))
+    start = max(0, resume["frame"] - RESUME_WARMUP) if resume else 0
+
+    # SaveWavePCM は同じ名前のファイルを上書きするので、再開するたびに
+    # 分離音の保存先を変え、中断前に書き出した分離音を残す。
+    # 各回の保存先と、その回が書き出す最初のフレーム番号をチェックポイントに
+    # 記録する（中断前の回の分離音のうち、次の回の最初のフレーム以降は
+    # 認識まで終わっていなかった部分で、次の回が書き直している）
+    wave_sessions = (resume.get("wave_sessions",
+                                [{"basename": "sep_", "frame": 0}])
+                     if resume else [])
+    wave_basename = ("sep_resume{:02d}_".format(len(wave_sessions))
+                     if wave_sessions else "sep_")
+    wave_sessions = wave_sessions + [
+        {"basename": wave_basename, "frame": resume["frame"] if resume else 0}]
+    if resume:
+        print("separated audio from frame {} is written to {}*.wav".format(
+            resume["frame"], wave_basename))
+
+    # スペクトルは定位と分離、音源情報は分離と認識が読み出す
+    spec_ring = SharedRingBuffer(SPEC_FIELDS, args.slots, nreaders=2)
+    source_ring = SharedRingBuffer(SOURCE_FIELDS, args.slots, nreaders=2)
+    separated_ring = SharedRingBuffer(SEPARATED_FIELDS, args.slots)
+    rings = [spec_ring, source_ring, separated_ring]
+
+    ctx = mp.get_context("spawn")
+    stats = ctx.Queue()
+    stages = [
+        ("HARK_Localization",
+         [("INPUT", spec_ring, 0, decode_spec)],
+         (source_ring, encode_sources)),
+        ("HARK_Separation",
+         [("SPEC", spec_ring, 1, decode_spec),
+          ("SOURCES", source_ring, 0, decode_sources)],
+         (separated_ring, encode_separated)),
+        ("HARK_Recognition",
+         [("INPUT", separated_ring, 0, decode_separated),
+          ("SOURCES", source_ring, 1, decode_sources)],
+         None),
+    ]
+    shared = ctx.RawArray("d", STAGE_STATS * len(stages))
+    # 出力済みの位置は再開位置の直前から数える
+    shared[-1] = (resume["frame"] if resume else 0) - 1
+    level = ctx.RawValue("i", 0)
+    tracker = None
+    if checkpointer is not None:
+        tracker = ctx.Array("d", TRACKER_FIELDS)
+        tracker[0] = resume["next_id"] if resume else 0
+    snapshot = ctx.RawArray("q", 3)
+    processes = [ctx.Process(target=run_stage,
+                             args=(s, i, o, stats, shared, n, level,
+                                   tracker, resume, rate, wave_basename,
+                                   snapshot if s == "HARK_Separation"
+                                   else None),
+                             name=s)
+                 for n, (s, i, o) in enumerate(stages)]
+    for p in processes:
+        p.start()
+
+    # 各プロセスが共有配列に書き込む統計値をメトリクスとして公開する
+    metrics = PipelineMetrics(advance=ADVANCE)
+    metrics.frames_consumed.func = lambda: int(shared[-STAGE_STATS])
+    metrics.frames_dropped.func = lambda: int(sum(
+        shared[n * STAGE_STATS + 3] for n in range(len(stages))))
+    metrics.active_sources.func = lambda: shared[2]
+    for n, (s, _, _) in enumerate(stages):
+        labels = {"stage": s}
+        metrics.registry.counter(
+            "stage_frames_total", "Frames processed by each subnetwork.",
+            labels, func=lambda n=n: shared[n * STAGE_STATS])
+        metrics.registry.counter(
+            "stage_seconds_total",
+            "Processing time spent in each subnetwork.",
+            labels, func=lambda n=n: shared[n * STAGE_STATS + 1])
+    metrics.registry.gauge(
+        "shed_level", "Current load shedding level (0 is full quality).",
+        func=lambda: level.value)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    # メインプロセスのネットワークを構築
+    network = hark.Network.from_networkdef(HARK_FrontEnd, name="HARK_FrontEnd")
+    publisher = network.query_nodedef("Publisher")
+    subscriber = network.query_nodedef("Subscriber")
+
+    # 入力ブロックは連続した int16 の配列にコピーして送信し、
+    # スペクトルが届いたらプールに返す
+    pending = collections.deque()
+    blocks = BufferPool(*FRAME_SHAPES["block"], size=256)
+
+    # 途中で終了したステージがあれば、パイプライン全体を止める
+    def stages_alive():
+        return all(p.is_alive() for p in processes)
+
+    def abandon_exited():
+        '''終了したステージの読み出しを外し出力を閉じて、
+        他のステージやメインプロセスがそのステージを待ち続けないようにする。
+        '''
+        for p, (_, inputs, output) in zip(processes, stages):
+            if p.exitcode is not None:
+                for _, ring, reader, _ in inputs:
+                    ring.leave(reader)
+                if output is not None:
+                    output[0].close()
+
+    def received(data):
+        frame, t_ns, block = pending.popleft()
+        blocks.release(block)
+        # ステージが終了していて空きができない場合は捨てる
+        spec_ring.write(frame, t_ns, alive=stages_alive, spec=data)
+
+    subscriber.receive = received
+
+    # 入力ファイル読み込み・フレーム分割
+    audio, rate = sf.read(args.filename, dtype=np.int16)
+    frames = sliding_window_view(audio, ADVANCE, axis=0)[::ADVANCE, :, :]
+
+    # 入力済みで最後のプロセスの処理が終わっていないフレーム数（backlog）から
+    # 遅れを求め、遅れに応じて処理の段階を選ぶ。
+    # backlog には LocalizeMUSIC や GHDSS の先読みによる一定の遅れが含まれるので、
+    # 出力が届き始めてからの backlog の最小値を基準とし、それを超えた分を遅れとする
+    shedder = None
+    finished = threading.Event()
+    if args.shed_deadline_ms is not None:
+        shedder = LoadShedder(args.shed_deadline_ms / 1e3)
+
+        def control():
+            baseline = None
+            while not finished.wait(0.1):
+                consumed = metrics.frames_consumed.value
+                backlog = metrics.frames_pushed.value - consumed
+                if consumed == 0:
+                    continue
+                if baseline is None or backlog < baseline:
+                    baseline = backlog
+                level.value = shedder.update(
+                    (backlog - baseline) * ADVANCE / rate)
+
+        threading.Thread(target=control, daemon=True).start()
+
+    # 最後のプロセスが出力し終えた位置・音源追跡の状態・GHDSS が書き出した
+    # 分離行列を定期的に保存する。
+    # 分離行列は書き込み中のものを読まないよう分離のプロセス自身にコピーさせる。
+    # 分離のプロセスが終了した後は、書き出した分離行列は
+    # スナップショットに移っているのでそちらを保存する
+    checkpoint_lock = threading.Lock()
+    warned = []
+
+    def ghdss_file(timeout=5.0):
+        '''チェックポイントに添付する分離行列のパスと、
+        それを保存したフレーム番号（不明な場合は None）を返す。
+        '''
+        separation = processes[1]
+        if separation.is_alive():
+            request = snapshot[0] + 1
+            snapshot[0] = request
+            deadline = time.monotonic() + timeout
+            while (snapshot[1] != request and separation.is_alive()
+                   and time.monotonic() < deadline):
+                time.sleep(0.01)
+            if snapshot[1] == request and snapshot[2] >= 0:
+                return snapshots.capture_path(key), int(snapshot[2])
+            if separation.is_alive():
+                if not warned:
+                    warned.append(True)
+                    print("GHDSS has not exported its separation matrix yet; "
+                          "checkpoints keep the matrix this run started from")
+                return snapshots.initial(key), None
+        if separation.exitcode == 0:
+            return (snapshots.initial(key),
+                    int(shared[STAGE_STATS + 4]))
+        return snapshots.initial(key), None
+
+    def save_checkpoint():
+        with checkpoint_lock:
+            ghdss, ghdss_frame = ghdss_file()
+            with tracker.get_lock():
+                next_id = int(tracker[0])
+                sources = [{"id": int(tracker[2 + 4 * i]),
+                            "x": list(tracker[3 + 4 * i:6 + 4 * i])}
+                           for i in range(int(tracker[1]))]
+            checkpointer.submit(
+                {"input": source, "frame": int(shared[-1]) + 1,
+                 "next_id": next_id, "sources": sources,
+                 "wave_sessions": wave_sessions, "ghdss_frame": ghdss_frame},
+                files={"ghdss": ghdss})
+
+    if checkpointer is not None:
+
+        def checkpoint_loop():
+            while not finished.wait(args.checkpoint_interval):
+                save_checkpoint()
+
+        threading.Thread(target=checkpoint_loop, daemon=True).start()
+
+    th = threading.Thread(target=network.execute)
+    th.start()
+
+    completed = False
+    t0 = time.monotonic()
+    try:
+        for t in range(start, len(frames)):
+            if not th.is_alive():
+                break
+            if not stages_alive():
+                for p in processes:
+                    if not p.is_alive():
+                        print("{} exited with code {}; stopping".format(
+                            p.name, p.exitcode))
+                abandon_exited()
+                break
+            block = blocks.copy(frames[t])
+            pending.append((t, time.monotonic_ns(), block))
+            metrics.frames_pushed.inc()
+            publisher.push(block)
+            if not args.no_realtime:
+                # 入力時刻に合わせて送信する（処理の遅れは累積させない）
+                delay = t0 + (t - start + 1) * ADVANCE / rate \
+                    - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        else:
+            completed = True
+
+    finally:
+        publisher.close()
+        network.stop()
+        th.join()
+        spec_ring.close()
+        finished.set()
+        if shedder is not None:
+            shedder.close()
+
+        # キューを読み出してからでないと子プロセスが終了できないことがある
+        results = []
+        while (len(results) < len(processes)
+               and any(p.is_alive() for p in processes)):
+            try:
+                results.append(stats.get(timeout=0.5))
+            except queue.Empty:
+                abandon_exited()
+        while not stats.empty():
+            results.append(stats.get())
+        for p in processes:
+            p.join()
+        for ring in rings:
+            ring.detach()
+        metrics.shutdown()
+
+        # 最後まで処理できた場合はチェックポイントを消し、
+        # そうでなければ終了時点の状態を保存する
+        if checkpointer is not None:
+            if completed and int(shared[-1]) + 1 >= len(frames):
+                checkpointer.remove()
+            else:
+                save_checkpoint()
+                checkpointer.close()
+
+    # 実時間比は、ステージが各フレームの処理に要した時間の合計から求める
+    # （経過時間は実時間に合わせて入力を待つ時間を含むため）
+    duration = (len(frames) - start) * ADVANCE / rate
+    names = [s for s, _, _ in stages]
+    for stage, count, elapsed, latency, grown in results:
+        busy = shared[names.index(stage) * STAGE_STATS + 1]
+        print("{}: {} frames in {:.2f}s ({:.1f} frames/s, RTF {:.2f})".format(
+            stage, count, elapsed, count / max(elapsed, 1e-9),
+            busy / duration))
+        if grown > 0:
+            print("  spectrum buffer pool grew by {} arrays".format(grown))
+        if latency:
+            ms = np.array(latency) / 1e6
+            print("  end-to-end latency [ms]: p50={:.1f} p95={:.1f} "
+                  "p99={:.1f} max={:.1f}".format(
+                      *np.percentile(ms, [50, 95, 99]), ms.max()))
+
+
+if __name__ == '__main__':
+    main()
+
+# end of file
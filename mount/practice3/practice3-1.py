@@ -20,6 +20,8 @@ import hark
 # import plotQuickMusicSpecKivy
 import plotQuickSourceKivy
 
+import tfbank
+
 
 class HARK_Localization(hark.NetworkDef):
     '''音源定位サブネットワークに相当するクラス。
@@ -47,7 +49,7 @@ class HARK_Localization(hark.NetworkDef):
             node_localize_music
             .add_input("INPUT", input["INPUT"])
             .add_input("NOISECM", node_cm_identity_matrix["OUTPUT"])
-            .add_input("A_MATRIX", "tf.zip")
+            .add_input("A_MATRIX", tfbank.path())
             .add_input("MUSIC_ALGORITHM", "SEVD")
             # .add_input("MUSIC_ALGORITHM", "GEVD")
             # .add_input("MUSIC_ALGORITHM", "GSVD")
@@ -190,7 +192,10 @@ def main():
     # 入力ファイル読み込み・フレーム分割
     audio, rate = sf.read(wavfilename, dtype=np.int16)
     advance = 160
-    frames = sliding_window_view(audio, advance, axis=0)[::advance, :, :]
+    # 読み込み時に1回だけ int16 のまま (フレーム数, チャネル数, advance) の
+    # 連続した配列にコピーし、各フレームはその配列のビューとして送信する
+    frames = np.ascontiguousarray(
+        sliding_window_view(audio, advance, axis=0)[::advance, :, :])
 
     # ネットワーク実行用スレッドを立ち上げ
     th = threading.Thread(target=network.execute)
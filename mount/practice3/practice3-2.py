@@ -5,6 +5,7 @@ import threading
 import time
 import argparse
 import tempfile
+import collections
 
 import numpy as np
 import sounddevice as sd
@@ -18,6 +19,11 @@ import plotQuickSpecKivy
 import plotQuickMusicSpecKivy
 import plotQuickSourceKivy
 
+from bufferpool import BufferPool, register
+from metrics import PipelineMetrics
+from recorder import RecordingTap
+import tfbank
+
 
 class HARK_Localization(hark.NetworkDef):
     '''音源定位サブネットワークに相当するクラス。
@@ -45,7 +51,7 @@ class HARK_Localization(hark.NetworkDef):
             node_localize_music
             .add_input("INPUT", input["INPUT"])
             .add_input("NOISECM", node_cm_identity_matrix["OUTPUT"])
-            .add_input("A_MATRIX", "tf.zip")
+            .add_input("A_MATRIX", tfbank.path())
             .add_input("MUSIC_ALGORITHM", "SEVD")
             # .add_input("MUSIC_ALGORITHM", "GEVD")
             # .add_input("MUSIC_ALGORITHM", "GSVD")
@@ -189,6 +195,16 @@ def main():
         '-c', '--channels', type=int, default=1, help='number of input channels')
     parser.add_argument(
         '-t', '--subtype', type=str, help='sound file subtype (e.g. "PCM_24")')
+    parser.add_argument(
+        '--rotate-size', type=float, metavar='MB',
+        help='start a new recording file every MB megabytes of samples '
+             '(uncompressed size for FLAC)')
+    parser.add_argument(
+        '--rotate-time', type=float, metavar='SECONDS',
+        help='start a new recording file every SECONDS seconds')
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
     args = parser.parse_args(remaining)
 
     if args.samplerate is None:
@@ -209,15 +225,51 @@ def main():
     publisher = network.query_nodedef("Publisher")
     subscriber = network.query_nodedef("Subscriber")
 
+    # 実行状況のメトリクス（フレーム数・キューの長さ・処理時間など）を公開する
+    metrics = PipelineMetrics(advance=160, sampling_rate=args.samplerate)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    pushed_at = collections.deque()
+
+    # 入力ブロックの配列は使い回し、ネットワークの出力が届いたら返却する
+    blocks = BufferPool((args.channels, 160), np.int16)
+    register(metrics.registry, {"block": blocks})
+
+    # 入力音声をファイルに保存する（書き込みは別スレッドで行う）
+    rotate_bytes = None
+    if args.rotate_size is not None:
+        rotate_bytes = int(args.rotate_size * 1024 * 1024)
+    recorder = RecordingTap(args.filename, args.samplerate, args.channels,
+                            subtype=args.subtype, rotate_bytes=rotate_bytes,
+                            rotate_seconds=args.rotate_time)
+    metrics.registry.counter(
+        "recording_dropped_blocks_total",
+        "Input blocks not written to the recording file.",
+        func=lambda: recorder.dropped)
+    metrics.frames_dropped.func = lambda: recorder.dropped
+
     def received(data):
         print(data)
-        pass
+        metrics.frames_consumed.inc()
+        metrics.active_sources.set(len(data))
+        if pushed_at:
+            t, block = pushed_at.popleft()
+            metrics.end_to_end_seconds.observe(time.monotonic() - t)
+            blocks.release(block)
 
     subscriber.receive = received
 
-    def callback(indata, frames, time, status):
-        print(indata.shape, time.currentTime)
-        publisher.push(indata.T)
+    def callback(indata, frames, time_info, status):
+        print(indata.shape, time_info.currentTime)
+        if status.input_overflow:
+            metrics.overruns.inc()
+        recorder.put(indata)
+        # indata は PortAudio が使い回すバッファなので、int16 のまま
+        # プールの (チャネル数, サンプル数) の配列にコピーして送信する
+        block = blocks.copy(indata.T)
+        pushed_at.append((time.monotonic(), block))
+        metrics.frames_pushed.inc()
+        publisher.push(block)
 
     # ネットワーク実行用スレッドを立ち上げ
     th = threading.Thread(target=network.execute)
@@ -246,6 +298,11 @@ def main():
         publisher.close()
         network.stop()
         th.join()
+        recorder.close()
+        if recorder.dropped > 0:
+            print('dropped {} of {} blocks while recording'.format(
+                recorder.dropped, recorder.blocks))
+        metrics.shutdown()
 
 
 if __name__ == '__main__':
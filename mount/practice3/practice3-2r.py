@@ -5,6 +5,8 @@ import threading
 import time
 import argparse
 import tempfile
+import collections
+import itertools
 
 import numpy as np
 import sounddevice as sd
@@ -18,6 +20,36 @@ import plotQuickSpecKivy
 import plotQuickMusicSpecKivy
 import plotQuickSourceKivy
 
+from fanout import FanoutPublisher, from_dict, from_sources
+from ghdss_warmstart import WarmStartStore
+from bufferpool import BufferPool, register
+from metrics import PipelineMetrics
+from recorder import RecordingTap
+import tfbank
+
+# GHDSS の分離行列を実行をまたいで引き継ぐ（伝達関数とアレイ構成ごとに保存する）
+ghdss_snapshots = WarmStartStore()
+
+# 入力のチャネル数とサンプリング周波数（main で入力の設定に合わせて変更する）
+num_channels = 8
+sampling_rate = 16000
+
+# SourceTracker が割り当てる音源IDの最小値
+# （チェックポイントから再開する場合に、以前のIDと重ならないよう変更する）
+source_min_id = 0
+
+# 音声認識の送信先のポート・音源定位結果を図示するか・分離音を保存する
+# ファイル名の先頭（loadtest.py のように1台で複数実行する場合に変更する）
+recognition_port = 5530
+plot_sources = True
+wave_basename = "sep_"
+
+
+def ghdss_key():
+    '''使用中の伝達関数と入力の構成から、分離行列のスナップショットのキーを作る。'''
+    return ghdss_snapshots.key(tfbank.path(), nch=num_channels,
+                               sampling_rate=sampling_rate)
+
 
 class HARK_Localization(hark.NetworkDef):
     '''音源定位サブネットワークに相当するクラス。
@@ -37,15 +69,13 @@ class HARK_Localization(hark.NetworkDef):
             hark.node.CMIdentityMatrix,
             dispatch=hark.RepeatDispatcher)
         node_source_tracker = network.create(hark.node.SourceTracker)
-        node_plotsource_kivy = network.create(
-            plotQuickSourceKivy.plotQuickSourceKivy)
 
         # ノード間の接続（データの流れ）とパラメータを記述する
         (
             node_localize_music
             .add_input("INPUT", input["INPUT"])
             .add_input("NOISECM", node_cm_identity_matrix["OUTPUT"])
-            .add_input("A_MATRIX", "tf.zip")
+            .add_input("A_MATRIX", tfbank.path())
             .add_input("MUSIC_ALGORITHM", "SEVD")
             #.add_input("MUSIC_ALGORITHM", "GEVD")
             #.add_input("MUSIC_ALGORITHM", "GSVD")
@@ -69,26 +99,35 @@ class HARK_Localization(hark.NetworkDef):
             .add_input("THRESH", 26.0)
             .add_input("PAUSE_LENGTH", 1200.0)
             .add_input("MIN_SRC_INTERVAL", 20.0)
-            .add_input("MIN_ID", 0)
+            .add_input("MIN_ID", source_min_id)
             .add_input("DEBUG", False)
         )
-        (
-            node_plotsource_kivy
-            .add_input("SOURCES", node_source_tracker["OUTPUT"])
-        )
-        (
-            output
-            .add_input("OUTPUT", node_plotsource_kivy["OUTPUT"])
-        )
 
         # ネットワークに含まれるノードの一覧をリストにする
         r = [
             node_localize_music,
             node_cm_identity_matrix,
             node_source_tracker,
-            node_plotsource_kivy,
         ]
 
+        if plot_sources:
+            node_plotsource_kivy = network.create(
+                plotQuickSourceKivy.plotQuickSourceKivy)
+            (
+                node_plotsource_kivy
+                .add_input("SOURCES", node_source_tracker["OUTPUT"])
+            )
+            (
+                output
+                .add_input("OUTPUT", node_plotsource_kivy["OUTPUT"])
+            )
+            r.append(node_plotsource_kivy)
+        else:
+            (
+                output
+                .add_input("OUTPUT", node_source_tracker["OUTPUT"])
+            )
+
         # ノード一覧のリストを返す
         return r
 
@@ -114,7 +153,19 @@ class HARK_Separation(hark.NetworkDef):
             node_ghdss
             .add_input("INPUT_FRAMES", input["SPEC"])
             .add_input("INPUT_SOURCES", input["SOURCES"])
-            .add_input("TF_CONJ_FILENAME", "tf.zip")
+            .add_input("TF_CONJ_FILENAME", tfbank.path())
+        )
+
+        # 前回までに学習した分離行列があれば初期値として与え、
+        # この実行の終わりに学習した分離行列を書き出す
+        key = ghdss_key()
+        initw = ghdss_snapshots.initial(key)
+        if initw is not None:
+            node_ghdss.add_input("INITW_FILENAME", initw)
+        (
+            node_ghdss
+            .add_input("EXPORT_W", True)
+            .add_input("EXPORT_W_FILENAME", ghdss_snapshots.export(key))
         )
         (
             node_synthesize
@@ -125,6 +176,7 @@ class HARK_Separation(hark.NetworkDef):
         (
             node_save_wave_pcm
             .add_input("INPUT", node_synthesize["OUTPUT"])
+            .add_input("BASENAME", wave_basename)
         )
         (
             output
@@ -215,7 +267,7 @@ class HARK_Recognition(hark.NetworkDef):
             .add_input("SOURCES", input["SOURCES"])
             .add_input("MFM_ENABLED", False)
             .add_input("HOST", "localhost")
-            .add_input("PORT", 5530)
+            .add_input("PORT", recognition_port)
             .add_input("SOCKET_ENABLED", True)
         )
         (
@@ -263,6 +315,13 @@ class HARK_Main(hark.NetworkDef):
         node_subscriber = network.create(
             hark.node.SubscribeData,
             name="Subscriber")
+        # 音源定位・音源分離の結果を取り出すための Subscriber
+        node_subscriber_sources = network.create(
+            hark.node.SubscribeData,
+            name="SubscriberSources")
+        node_subscriber_separation = network.create(
+            hark.node.SubscribeData,
+            name="SubscriberSeparation")
 
         node_audio_stream_from_memory = network.create(
             hark.node.AudioStreamFromMemory,
@@ -306,11 +365,21 @@ class HARK_Main(hark.NetworkDef):
             node_subscriber
             .add_input("INPUT", node_recognition["OUTPUT"])
         )
+        (
+            node_subscriber_sources
+            .add_input("INPUT", node_localization["OUTPUT"])
+        )
+        (
+            node_subscriber_separation
+            .add_input("INPUT", node_separation["SPECTRUM"])
+        )
 
         # ネットワークに含まれるノードの一覧をリストにして返す
         r = [
             node_publisher,
             node_subscriber,
+            node_subscriber_sources,
+            node_subscriber_separation,
             node_audio_stream_from_memory,
             node_multi_fft,
             node_localization,
@@ -353,6 +422,19 @@ def main():
         '-c', '--channels', type=int, default=1, help='number of input channels')
     parser.add_argument(
         '-t', '--subtype', type=str, help='sound file subtype (e.g. "PCM_24")')
+    parser.add_argument(
+        '--rotate-size', type=float, metavar='MB',
+        help='start a new recording file every MB megabytes of samples '
+             '(uncompressed size for FLAC)')
+    parser.add_argument(
+        '--rotate-time', type=float, metavar='SECONDS',
+        help='start a new recording file every SECONDS seconds')
+    parser.add_argument(
+        '--fanout', metavar='PATH',
+        help='publish results to consumers on this Unix socket')
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
     args = parser.parse_args(remaining)
 
     if args.samplerate is None:
@@ -365,6 +447,9 @@ def main():
     if args.filename is None:
         args.filename = tempfile.mktemp(prefix='practice3-1a_',
                                         suffix='.wav', dir='')
+    global num_channels, sampling_rate
+    num_channels = args.channels
+    sampling_rate = args.samplerate
 
     # メインネットワークを構築
     network = hark.Network.from_networkdef(HARK_Main, name="HARK_Main")
@@ -373,15 +458,77 @@ def main():
     publisher = network.query_nodedef("Publisher")
     subscriber = network.query_nodedef("Subscriber")
 
+    # 実行状況のメトリクス（フレーム数・キューの長さ・処理時間など）を公開する
+    metrics = PipelineMetrics(advance=160, sampling_rate=args.samplerate)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    pushed_at = collections.deque()
+
+    # 入力ブロックの配列は使い回し、ネットワークの出力が届いたら返却する
+    blocks = BufferPool((args.channels, 160), np.int16)
+    register(metrics.registry, {"block": blocks})
+
+    # 入力音声をファイルに保存する（書き込みは別スレッドで行う）
+    rotate_bytes = None
+    if args.rotate_size is not None:
+        rotate_bytes = int(args.rotate_size * 1024 * 1024)
+    recorder = RecordingTap(args.filename, args.samplerate, args.channels,
+                            subtype=args.subtype, rotate_bytes=rotate_bytes,
+                            rotate_seconds=args.rotate_time)
+    metrics.registry.counter(
+        "recording_dropped_blocks_total",
+        "Input blocks not written to the recording file.",
+        func=lambda: recorder.dropped)
+    metrics.frames_dropped.func = lambda: recorder.dropped
+
+    # 定位・分離・特徴量の結果を複数の利用者に配信する
+    fanout = None
+    if args.fanout is not None:
+        fanout = FanoutPublisher(args.fanout)
+        metrics.registry.counter(
+            "fanout_dropped_messages_total",
+            "Messages dropped for slow fan-out consumers.",
+            func=lambda: fanout.dropped)
+
+    def publish_to(topic, convert):
+        frame = itertools.count()
+
+        def receive(data):
+            if fanout is not None:
+                fanout.publish(topic, next(frame), time.monotonic_ns(),
+                               convert(data))
+
+        return receive
+
+    network.query_nodedef("SubscriberSources").receive = \
+        publish_to("sources", from_sources)
+    network.query_nodedef("SubscriberSeparation").receive = \
+        publish_to("separation", from_dict)
+    publish_features = publish_to("features", from_dict)
+
     def received(data):
         print(data)
-        pass
+        publish_features(data)
+        metrics.frames_consumed.inc()
+        metrics.active_sources.set(len(data))
+        if pushed_at:
+            t, block = pushed_at.popleft()
+            metrics.end_to_end_seconds.observe(time.monotonic() - t)
+            blocks.release(block)
 
     subscriber.receive = received
 
-    def callback(indata, frames, time, status):
-        print(indata.shape, time.currentTime)
-        publisher.push(indata.T)
+    def callback(indata, frames, time_info, status):
+        print(indata.shape, time_info.currentTime)
+        if status.input_overflow:
+            metrics.overruns.inc()
+        recorder.put(indata)
+        # indata は PortAudio が使い回すバッファなので、int16 のまま
+        # プールの (チャネル数, サンプル数) の配列にコピーして送信する
+        block = blocks.copy(indata.T)
+        pushed_at.append((time.monotonic(), block))
+        metrics.frames_pushed.inc()
+        publisher.push(block)
 
     # ネットワーク実行用スレッドを立ち上げ
     th = threading.Thread(target=network.execute)
@@ -410,6 +557,14 @@ def main():
         publisher.close()
         network.stop()
         th.join()
+        ghdss_snapshots.commit(ghdss_key())
+        if fanout is not None:
+            fanout.close()
+        recorder.close()
+        if recorder.dropped > 0:
+            print('dropped {} of {} blocks while recording'.format(
+                recorder.dropped, recorder.blocks))
+        metrics.shutdown()
 
 
 if __name__ == '__main__':
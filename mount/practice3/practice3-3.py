@@ -5,6 +5,7 @@
 音源定位を行い結果を表示する。
 '''
 
+import os
 import sys
 # import threading
 # import time
@@ -15,6 +16,11 @@ from numpy.lib.stride_tricks import sliding_window_view
 
 import hark
 
+import kaldi_export
+from ghdss_warmstart import WarmStartStore
+from stft_engine import BatchSTFT
+import tfbank
+
 
 def main():
     # コマンドライン引数の処理
@@ -22,25 +28,43 @@ def main():
         print("no input file")
         return
     wavfilename = sys.argv[1]
+    # 2番目の引数を与えた場合は、特徴量を音声認識サーバに送らずに
+    # そのディレクトリへ Kaldi の ark/scp 形式で書き出す
+    export_dir = sys.argv[2] if len(sys.argv) > 2 else None
+
+    # 環境変数 HARK_BATCH_STFT=1 を与えた場合は MultiFFT の代わりに
+    # NumPy で実装した STFT（stft_engine.BatchSTFT）を使う。
+    # MultiFFT と同じ出力になることを確認するまでは試験的な扱いとする
+    batch_stft = os.environ.get("HARK_BATCH_STFT") == "1"
 
     # WAVファイル読み込み
-    audio, rate = sf.read(wavfilename, dtype=np.float32)
+    # BatchSTFT では int16 のまま読み込み、float32 への変換と正規化は
+    # STFT の窓掛けで行う
+    audio, rate = sf.read(wavfilename,
+                          dtype=np.int16 if batch_stft else np.float32)
     # print(audio.shape)
 
     nch = audio.shape[1]
+    # 使用するアレイの伝達関数（環境変数 HARK_TF_PROFILE で選ぶ）
+    tf_filename = tfbank.path()
     frame_size = 512
     advance = 160
 
-    frames = sliding_window_view(audio, frame_size, axis=0)[::advance, :, :]
-    # print(type(frames), frames.shape)
+    if batch_stft:
+        stft = BatchSTFT(frame_size, advance, sampling_rate=rate,
+                         scale=1.0/32768)
+        spec = stft.stft(audio)
+    else:
+        frames = sliding_window_view(audio, frame_size, axis=0)[::advance, :, :]
+        # print(type(frames), frames.shape)
 
-    # multi_gain = hark.node.MultiGain()
-    # frames = multi_gain(INPUT=frames, GAIN=1024.0).OUTPUT
-    # print(type(frames), frames.shape)
+        # multi_gain = hark.node.MultiGain()
+        # frames = multi_gain(INPUT=frames, GAIN=1024.0).OUTPUT
+        # print(type(frames), frames.shape)
 
-    multi_fft = hark.node.MultiFFT()
-    spec = multi_fft(INPUT=frames)
-    # print(spec.OUTPUT.shape)
+        multi_fft = hark.node.MultiFFT()
+        spec = multi_fft(INPUT=frames).OUTPUT
+    # print(spec.shape)
 
     ########################################
     # 音源定位処理
@@ -54,13 +78,13 @@ def main():
     # Numpyのブロードキャスト機能で配列のインデックスを拡張する。
     noise_cm = np.broadcast_to(
         np.eye(nch, dtype=np.complex64).flatten(),
-        (frames.shape[0], frame_size//2+1, nch*nch))
+        (spec.shape[0], frame_size//2+1, nch*nch))
 
     # MUSIC法による音源定位（MUSICスペクトルの計算）を行う
     localize_music = hark.node.LocalizeMUSIC()
     music_spec = localize_music(
-        INPUT=spec.OUTPUT,
-        A_MATRIX='tf.zip',
+        INPUT=spec,
+        A_MATRIX=tf_filename,
         MUSIC_ALGORITHM='SEVD',
         NOISECM=noise_cm,
         # PERIOD=1,
@@ -90,11 +114,22 @@ def main():
     ########################################
 
     # GHDSSによる音源分離処理を行う
+    # 前回までに学習した分離行列があれば初期値として与え、
+    # 学習した分離行列を書き出して次の実行に引き継ぐ
+    snapshots = WarmStartStore()
+    key = snapshots.key(tf_filename, nch=nch, sampling_rate=rate)
+    warm_start = {}
+    initw = snapshots.initial(key)
+    if initw is not None:
+        warm_start['INITW_FILENAME'] = initw
     ghdss = hark.node.GHDSS()
     ghdss_output = ghdss(
-        INPUT_FRAMES=spec.OUTPUT,
+        INPUT_FRAMES=spec,
         INPUT_SOURCES=src_info_ext.OUTPUT,
-        TF_CONJ_FILENAME='tf.zip')
+        TF_CONJ_FILENAME=tf_filename,
+        EXPORT_W=True,
+        EXPORT_W_FILENAME=snapshots.export(key),
+        **warm_start)
     # print(type(ghdss_output.OUTPUT), len(ghdss_output.OUTPUT))
     # for g in ghdss_output.OUTPUT:
     #     for k in g.keys():
@@ -160,6 +195,19 @@ def main():
         SM_HISTORY=False,
         PERIOD=1)
 
+    if export_dir is not None:
+        # 音源追跡の区間ごとに特徴量を書き出す
+        name = os.path.splitext(os.path.basename(wavfilename))[0]
+        with kaldi_export.ArkWriter(
+                os.path.join(export_dir, name + ".ark")) as writer:
+            count = kaldi_export.export(writer, name,
+                                        normalized_features.OUTPUT,
+                                        src_info.OUTPUT)
+        print("{} utterances written to {}".format(count, writer.scp))
+        # すべての処理が終わり GHDSS が分離行列を書き出してから保存する
+        snapshots.commit(key)
+        return
+
     # Kaldidecoderに特徴量を送信する
     speech_recognition_client = hark.node.SpeechRecognitionClient()
     asr_result = speech_recognition_client(
@@ -171,6 +219,9 @@ def main():
         SOCKET_ENABLED=True)
     print("Speech recognition processing ...")
 
+    # すべての処理が終わり GHDSS が分離行列を書き出してから保存する
+    snapshots.commit(key)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,135 @@
+'''オンライン処理と並行して入力音声をファイルに保存するモジュール。
+sounddevice のコールバックではブロックをキューにコピーするだけにし、
+ファイルへの書き込みは別スレッドでまとめて行う。
+ディスクの書き込みが遅れてもコールバックやネットワークは止まらず、
+キューがあふれた場合はブロックを捨てて dropped に数える。
+'''
+
+import os
+import queue
+import threading
+
+import numpy as np
+import soundfile as sf
+
+
+# サブタイプごとの1サンプルあたりのバイト数（非圧縮の場合）
+SAMPLE_BYTES = {
+    "PCM_S8": 1, "PCM_U8": 1, "ULAW": 1, "ALAW": 1,
+    "PCM_16": 2, "PCM_24": 3, "PCM_32": 4, "FLOAT": 4, "DOUBLE": 8,
+}
+
+
+def sample_bytes(filename, subtype=None):
+    '''filename に subtype で保存する場合の1サンプルあたりのバイト数を返す。
+    subtype を省略した場合はファイル形式の既定のサブタイプを使う。
+    FLAC などの圧縮形式では圧縮前のバイト数になる。
+    '''
+    if subtype is None:
+        ext = os.path.splitext(filename)[1].lstrip(".").upper()
+        subtype = sf.default_subtype(ext) or "PCM_16"
+    return SAMPLE_BYTES.get(subtype.upper(), 2)
+
+
+class RecordingTap:
+    '''入力ブロックを WAV/FLAC ファイルに書き込むクラス。
+
+    filename:       保存先（拡張子からファイル形式を決める）
+    max_blocks:     書き込み待ちにできるブロック数
+    write_frames:   1回の書き込みでまとめるサンプル数
+    rotate_bytes:   1ファイルあたりの最大バイト数（ヘッダを除く音声データの量。
+                    subtype のサンプルの大きさから求め、FLAC では圧縮前の量）
+    rotate_seconds: 1ファイルあたりの最大秒数
+    いずれかのローテーションを指定した場合、ファイル名の末尾に
+    _0000, _0001, ... の通し番号を付ける。
+    '''
+
+    def __init__(self, filename, samplerate, channels, subtype=None,
+                 max_blocks=1024, write_frames=16000,
+                 rotate_bytes=None, rotate_seconds=None):
+        self.filename = filename
+        self.samplerate = samplerate
+        self.channels = channels
+        self.subtype = subtype
+        self.write_frames = write_frames
+        self.rotate_frames = None
+        if rotate_seconds is not None:
+            self.rotate_frames = int(rotate_seconds * samplerate)
+        if rotate_bytes is not None:
+            frames = int(rotate_bytes
+                         // (sample_bytes(filename, subtype) * channels))
+            self.rotate_frames = min(self.rotate_frames or frames, frames)
+
+        self.blocks = 0
+        self.dropped = 0
+        self.frames_written = 0
+        self.files = []
+
+        self._queue = queue.Queue(max_blocks)
+        self._file = None
+        self._file_frames = 0
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def put(self, block):
+        '''(サンプル数, チャネル数) のブロックをコピーしてキューに入れる。
+        コールバックから呼ぶため待たずに戻り、キューが満杯なら捨てる。
+        '''
+        self.blocks += 1
+        try:
+            self._queue.put_nowait(block.copy())
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        name = self.filename
+        if self.rotate_frames is not None:
+            root, ext = os.path.splitext(self.filename)
+            name = "{}_{:04d}{}".format(root, len(self.files), ext)
+        self._file = sf.SoundFile(name, mode='w', samplerate=self.samplerate,
+                                  channels=self.channels, subtype=self.subtype)
+        self._file_frames = 0
+        self.files.append(name)
+
+    def _write(self, data):
+        while len(data) > 0:
+            if self._file is None:
+                self._open()
+            n = len(data)
+            if self.rotate_frames is not None:
+                n = min(n, self.rotate_frames - self._file_frames)
+            self._file.write(data[:n])
+            self._file_frames += n
+            self.frames_written += n
+            data = data[n:]
+            if (self.rotate_frames is not None
+                    and self._file_frames >= self.rotate_frames):
+                self._file.close()
+                self._file = None
+
+    def _writer(self):
+        pending = []
+        count = 0
+        while True:
+            block = self._queue.get()
+            if block is not None:
+                pending.append(block)
+                count += len(block)
+            # ある程度たまってから、まとめて1回で書き込む
+            if pending and (block is None or count >= self.write_frames):
+                self._write(np.concatenate(pending))
+                pending = []
+                count = 0
+            if block is None:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        '''キューに残ったブロックを書き込み、ファイルを閉じる。'''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+# end of file
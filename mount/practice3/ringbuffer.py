@@ -0,0 +1,188 @@
+'''プロセス間でフレーム単位のデータを受け渡す共有メモリ上のリングバッファ。
+multiprocessing.shared_memory 上に固定長のスロットを確保し、
+スペクトルや音源情報を pickle せずに NumPy 配列として直接書き込む。
+書き込み側は1つ、読み出し側は複数（nreaders）を想定する。
+読み出し側が終了するときは leave() を呼び、書き込み側がその読み出し側を
+待たないようにする。
+各スロットにはフレーム番号と入力時刻を付けるため、
+受け取った側でフレームの順序と遅延を確認できる。
+'''
+
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# ヘッダ: [書き込み済みスロット数, 終了フラグ, 読み出し済みスロット数 x nreaders]
+_HEADER_WRITE = 0
+_HEADER_CLOSED = 1
+_HEADER_READ = 2
+_ALIGN = 64
+
+# leave() した読み出し側の読み出し済みスロット数
+_GONE = np.iinfo(np.int64).max
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _attach(name):
+    '''既存の共有メモリに接続する。
+    Python 3.13 以降では、接続しただけのプロセスが共有メモリを
+    破棄しないよう resource_tracker の管理対象から外す。
+    （それ以前は子プロセスが親と同じ resource_tracker を共有するため問題ない）
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedRingBuffer:
+    '''共有メモリ上のリングバッファ。
+
+    fields:   {名前: (形状, dtype)} の辞書。スロットごとに各フィールドの配列をもつ
+    nslots:   スロット数
+    nreaders: 読み出し側の数。書き込み側は最も遅い読み出し側を待つ
+    poll:     空き・データを待つときのポーリング間隔 [秒]
+
+    プロセスの引数として渡すと、子プロセス側では同じ共有メモリに接続する。
+    '''
+
+    def __init__(self, fields, nslots=256, nreaders=1, poll=0.0005,
+                 name=None):
+        self.fields = {k: (tuple(shape), np.dtype(dtype))
+                       for k, (shape, dtype) in fields.items()}
+        self.nslots = nslots
+        self.nreaders = nreaders
+        self.poll = poll
+
+        # 各配列の共有メモリ上のオフセットを決める
+        layout = [("_header", (2 + nreaders,), np.dtype(np.int64)),
+                  ("_meta", (nslots, 2), np.dtype(np.int64))]
+        layout += [(k, (nslots,) + shape, dtype)
+                   for k, (shape, dtype) in self.fields.items()]
+        offset = 0
+        self._layout = []
+        for key, shape, dtype in layout:
+            self._layout.append((key, shape, dtype, offset))
+            offset += _aligned(int(np.prod(shape)) * dtype.itemsize)
+
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=offset)
+        else:
+            self._shm = _attach(name)
+        self._arrays = {
+            key: np.ndarray(shape, dtype=dtype, buffer=self._shm.buf,
+                            offset=off)
+            for key, shape, dtype, off in self._layout}
+        self._header = self._arrays["_header"]
+        self._meta = self._arrays["_meta"]
+        if self._owner:
+            self._header[...] = 0
+
+    def __getstate__(self):
+        return (self.fields, self.nslots, self.nreaders, self.poll,
+                self._shm.name)
+
+    def __setstate__(self, state):
+        fields, nslots, nreaders, poll, name = state
+        self.__init__(fields, nslots, nreaders, poll, name)
+
+    @property
+    def closed(self):
+        return bool(self._header[_HEADER_CLOSED])
+
+    def pending(self, reader=0):
+        '''読み出し側 reader がまだ読んでいないスロット数を返す。'''
+        return int(self._header[_HEADER_WRITE]
+                   - self._header[_HEADER_READ + reader])
+
+    def _slowest(self):
+        reads = self._header[_HEADER_READ:]
+        reads = reads[reads != _GONE]
+        return int(reads.min()) if len(reads) > 0 else None
+
+    def reserve(self, timeout=None, alive=None):
+        '''書き込み用の空きスロットを待ち、{フィールド名: 配列} を返す。
+        書き込み後に commit() を呼ぶ。leave() した読み出し側は待たない。
+        timeout 秒以内に空かない場合と、待つ間に呼ぶ alive() が False を返した
+        場合（読み出し側のプロセスが終了した場合など）は None を返す。
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        write = int(self._header[_HEADER_WRITE])
+        while True:
+            slowest = self._slowest()
+            if slowest is None or write - slowest < self.nslots:
+                break
+            if alive is not None and not alive():
+                return None
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(self.poll)
+        slot = write % self.nslots
+        return {k: self._arrays[k][slot] for k in self.fields}
+
+    def commit(self, frame, t_ns):
+        '''reserve() したスロットにフレーム番号と入力時刻を付けて公開する。'''
+        write = int(self._header[_HEADER_WRITE])
+        self._meta[write % self.nslots] = (frame, t_ns)
+        self._header[_HEADER_WRITE] = write + 1
+
+    def write(self, frame, t_ns, timeout=None, alive=None, **values):
+        '''空きスロットを待って values を書き込み、公開する。
+        timeout と alive は reserve() と同じ。書き込めなかった場合は False を返す。
+        '''
+        slot = self.reserve(timeout, alive)
+        if slot is None:
+            return False
+        for k, v in values.items():
+            slot[k][...] = v
+        self.commit(frame, t_ns)
+        return True
+
+    def read(self, reader=0, timeout=None):
+        '''次のスロットを待ち、(フレーム番号, 入力時刻, {フィールド名: 配列}) を返す。
+        配列は共有メモリ上のビューなので、使い終わったら release() を呼ぶ。
+        書き込み側が close() 済みでデータが残っていなければ None を返す。
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        read = int(self._header[_HEADER_READ + reader])
+        while int(self._header[_HEADER_WRITE]) <= read:
+            if self._header[_HEADER_CLOSED]:
+                return None
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(self.poll)
+        slot = read % self.nslots
+        frame, t_ns = self._meta[slot]
+        return (int(frame), int(t_ns),
+                {k: self._arrays[k][slot] for k in self.fields})
+
+    def release(self, reader=0):
+        '''read() したスロットを解放する。'''
+        self._header[_HEADER_READ + reader] += 1
+
+    def leave(self, reader=0):
+        '''読み出し側 reader がこれ以上読み出さないことを書き込み側に通知する。
+        読み出し側のプロセスが終了するとき（異常終了した場合は親プロセスが）呼ぶ。
+        '''
+        self._header[_HEADER_READ + reader] = _GONE
+
+    def close(self):
+        '''書き込みの終了を読み出し側に通知する。'''
+        self._header[_HEADER_CLOSED] = 1
+
+    def detach(self):
+        '''共有メモリから切り離す。作成したプロセスでは共有メモリを破棄する。'''
+        self._arrays = {}
+        self._header = None
+        self._meta = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+# end of file
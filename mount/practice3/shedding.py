@@ -0,0 +1,107 @@
+'''実時間処理が間に合わなくなったときに、処理の質を段階的に下げるモジュール。
+入力フレームの期限（入力時刻）からの遅れを監視し、遅れが deadline を超えると
+次の段階に下げ、遅れが十分に小さくなると1段階ずつ元に戻す。
+段階を変えるたびに、それまでの段階とその継続時間を表示する。
+
+各段階では次の処理の省略を指定できる。
+
+  localize_every: N フレームに1回だけ音源定位のネットワークにスペクトルを入力し、
+                  間のフレームは直前の定位結果を使う
+  min_power:      パワーがこの値より小さい音源を後段に渡さない
+                  （GHDSS による分離と音声認識を行わない）
+  recognition:    False の場合は特徴量抽出と音声認識への送信を止める
+
+localize_every は LocalizeMUSIC の PERIOD を大きくするのとは異なる。
+PERIOD は相関行列の計算に全フレームを使い、固有値分解の間隔だけを広げるが、
+localize_every では入力するフレーム自体を間引く。そのため WINDOW フレームの
+相関行列が WINDOW * N フレーム分の音響信号を粗く平均したものになり、
+短い発話や動く音源に対する定位の精度が下がる。また元の段階に戻った後も、
+間引いたフレームが WINDOW フレーム分入れ替わるまでは影響が残る。
+定位の計算量は 1/N になるため、精度の低下と引き換えに遅れを解消する段階として使う。
+
+遅れ（update() に与える値）には、ネットワークの先読みによる一定の遅れを
+含めないこと。含めると、deadline がその遅れより小さい場合に
+常に段階が下がったままになる。
+'''
+
+import time
+
+
+class Level:
+    '''処理の質の1段階を表すクラス。'''
+
+    def __init__(self, name, localize_every=1, min_power=None,
+                 recognition=True):
+        self.name = name
+        self.localize_every = localize_every
+        self.min_power = min_power
+        self.recognition = recognition
+
+
+# 既定の段階（先頭が通常の処理）
+DEFAULT_LEVELS = [
+    Level("full"),
+    Level("localize_every_5", localize_every=5),
+    Level("strong_sources_only", localize_every=5, min_power=30.0),
+    Level("no_recognition", localize_every=10, min_power=30.0,
+          recognition=False),
+]
+
+
+class LoadShedder:
+    '''遅れに応じて段階を選ぶコントローラ。
+
+    deadline: 許容する遅れ [s]。これを超えると1段階下げる
+    recover:  遅れが deadline * recover を下回ると1段階戻す
+    hold:     段階を変えてから次に変えるまでの最短時間 [s]
+    '''
+
+    def __init__(self, deadline, levels=DEFAULT_LEVELS, recover=0.5,
+                 hold=2.0, log=print):
+        self.deadline = deadline
+        self.levels = levels
+        self.recover = recover
+        self.hold = hold
+        self.log = log
+        self.index = 0
+        self.history = []
+        self._since = time.monotonic()
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    def update(self, lateness, now=None):
+        '''現在の遅れ [s] を与え、選んだ段階の番号を返す。'''
+        now = time.monotonic() if now is None else now
+        if now - self._since < self.hold:
+            return self.index
+        if lateness > self.deadline and self.index < len(self.levels) - 1:
+            self._change(self.index + 1, lateness, now)
+        elif lateness < self.deadline * self.recover and self.index > 0:
+            self._change(self.index - 1, lateness, now)
+        return self.index
+
+    def _change(self, index, lateness, now):
+        previous = self.level
+        duration = now - self._since
+        self.history.append((previous.name, self._since, duration))
+        self.index = index
+        self._since = now
+        self.log("load shedding: {} -> {} (lateness {:.0f} ms, "
+                 "{} lasted {:.1f} s)".format(
+                     previous.name, self.level.name, lateness * 1e3,
+                     previous.name, duration))
+
+    def close(self, now=None):
+        '''最後の段階を履歴に加え、通常以外の段階の合計時間を表示する。'''
+        now = time.monotonic() if now is None else now
+        self.history.append((self.level.name, self._since, now - self._since))
+        degraded = {}
+        for name, _, duration in self.history:
+            if name != self.levels[0].name:
+                degraded[name] = degraded.get(name, 0.0) + duration
+        for name, duration in degraded.items():
+            self.log("load shedding: {:.1f} s at {}".format(duration, name))
+
+# end of file
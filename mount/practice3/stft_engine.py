@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+'''オフライン処理向けのバッチ型STFT/ISTFTエンジン。
+MultiFFTノードとSynthesizeノードの代わりに、全チャネル・全フレームに対する
+実FFTをチャンク単位でまとめて計算する。
+出力するスペクトルは MultiFFT と同じ (フレーム数, チャネル数, 周波数ビン数) の
+complex64 配列であり、そのまま LocalizeMUSIC や GHDSS に入力できる。
+
+引数としてWAVファイルを与えて実行すると、MultiFFT / Synthesize との
+出力の一致と処理時間の比較を表示する。
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# scipy があればマルチスレッドFFTを使い、なければ numpy.fft で代用する
+try:
+    import scipy.fft as _fft
+    _FFT_HAS_WORKERS = True
+except ImportError:
+    _fft = np.fft
+    _FFT_HAS_WORKERS = False
+
+
+def conj_window(length):
+    '''HARK（FlowDesigner）の CONJ 窓を作成する。
+    MultiFFT の既定の窓関数と同じもの。
+    '''
+    x = 4.0 * np.arange(length) / length
+    inv = (x >= 1.0) & (x < 3.0)
+    x = np.where(x < 1.0, x,
+                 np.where(x < 2.0, 2.0 - x,
+                          np.where(x < 3.0, x - 2.0, 4.0 - x)))
+    tmp = (0.5 - 0.5 * np.cos(0.5 * np.pi * 1.271903 * x)) ** 2
+    tmp = np.where(inv, 1.0 - tmp, tmp)
+    return np.sqrt(tmp).astype(np.float32)
+
+
+def make_window(name, length):
+    '''名前（HARKのWINDOWパラメータと同じ表記）から窓関数を作成する。'''
+    if name == "CONJ":
+        return conj_window(length)
+    if name == "HAMMING":
+        return np.hamming(length).astype(np.float32)
+    if name == "HANNING":
+        return np.hanning(length).astype(np.float32)
+    if name == "RECTANGLE":
+        return np.ones(length, dtype=np.float32)
+    raise ValueError("unknown window: " + repr(name))
+
+
+class BatchSTFT:
+    '''全チャネル・全フレームをまとめて処理するSTFT/ISTFTエンジン。
+    フレーム分割は各スクリプトの
+    sliding_window_view(audio, length, axis=0)[::advance] と同じ。
+    作業用バッファはチャンク単位で確保して使い回す。
+
+    入力は soundfile で dtype=np.int16 として読み込んだ (サンプル数, チャネル数)
+    の配列をそのまま与えられる。float32 への変換と scale 倍の正規化は
+    窓掛けと1回の演算にまとめて行うため、信号全体の float32 コピーは作らない。
+    scale=1/32768 とすると dtype=np.float32 で読み込んだ場合と同じ値になる。
+    '''
+
+    def __init__(self,
+                 length=512,
+                 advance=160,
+                 window="CONJ",
+                 synthesis_window="HAMMING",
+                 sampling_rate=16000,
+                 min_frequency=125,
+                 max_frequency=7900,
+                 output_gain=1.0,
+                 scale=1.0,
+                 chunk_frames=1024,
+                 workers=None):
+        self.length = length
+        self.advance = advance
+        self.nbin = length // 2 + 1
+        self.window = make_window(window, length)
+        self.synthesis_window = make_window(synthesis_window, length)
+        self.scale = scale
+        self._analysis = (self.window * scale).astype(np.float32)
+        self.sampling_rate = sampling_rate
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.output_gain = output_gain
+        self.chunk_frames = chunk_frames
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+
+        # 合成時に有効とする周波数ビンのマスク（Synthesize の
+        # MIN_FREQUENCY / MAX_FREQUENCY に相当）
+        freqs = np.arange(self.nbin) * sampling_rate / length
+        self._band = ((freqs >= min_frequency)
+                      & (freqs <= max_frequency)).astype(np.float32)
+
+        # 重畳加算の正規化係数（advance 周期で一定になる）
+        nseg = -(-length // advance)
+        w = np.zeros(nseg * advance, dtype=np.float64)
+        w[:length] = self.window * self.synthesis_window
+        self._ola_norm = (w.reshape(nseg, advance).sum(axis=0)
+                          / output_gain).astype(np.float32)
+
+        self._scratch = None
+
+    def _rfft(self, x):
+        if _FFT_HAS_WORKERS:
+            return _fft.rfft(x, axis=-1, workers=self.workers)
+        return _fft.rfft(x, axis=-1)
+
+    def _irfft(self, x):
+        if _FFT_HAS_WORKERS:
+            return _fft.irfft(x, n=self.length, axis=-1, workers=self.workers)
+        return _fft.irfft(x, n=self.length, axis=-1)
+
+    def _get_scratch(self, shape):
+        if self._scratch is None or self._scratch.shape != shape:
+            self._scratch = np.empty(shape, dtype=np.float32)
+        return self._scratch
+
+    def num_frames(self, nsamples):
+        '''nsamples サンプルの信号から得られるフレーム数を返す。'''
+        if nsamples < self.length:
+            return 0
+        return (nsamples - self.length) // self.advance + 1
+
+    def stft(self, audio, out=None):
+        '''(サンプル数, チャネル数) の多チャネル信号をフーリエ変換し、
+        (フレーム数, チャネル数, 周波数ビン数) の complex64 配列を返す。
+        out を与えた場合はそこに結果を書き込む。
+        '''
+        nframes = self.num_frames(audio.shape[0])
+        nch = audio.shape[1]
+        if out is None:
+            out = np.empty((nframes, nch, self.nbin), dtype=np.complex64)
+
+        frames = sliding_window_view(
+            audio, self.length, axis=0)[::self.advance]
+        for start in range(0, nframes, self.chunk_frames):
+            stop = min(start + self.chunk_frames, nframes)
+            buf = self._get_scratch(
+                (self.chunk_frames, nch, self.length))[:stop - start]
+            # 窓掛け・正規化・float32への変換・連続化を1回の演算で行う
+            np.multiply(frames[start:stop], self._analysis, out=buf)
+            out[start:stop] = self._rfft(buf)
+        return out
+
+    def istft(self, spec, out=None):
+        '''(フレーム数, 音源数, 周波数ビン数) のスペクトルを重畳加算で合成し、
+        (音源数, サンプル数) の float32 波形を返す。
+        '''
+        nframes, nsrc = spec.shape[0], spec.shape[1]
+        nseg = -(-self.length // self.advance)
+        nblocks = nframes + nseg - 1
+        if out is None:
+            out = np.zeros((nsrc, nblocks * self.advance), dtype=np.float32)
+        else:
+            out[...] = 0.0
+        blocks = out.reshape(nsrc, nblocks, self.advance)
+
+        win = np.zeros(nseg * self.advance, dtype=np.float32)
+        win[:self.length] = self.synthesis_window
+        for start in range(0, nframes, self.chunk_frames):
+            stop = min(start + self.chunk_frames, nframes)
+            n = stop - start
+            wave = self._irfft(spec[start:stop] * self._band)
+            seg = np.zeros((n, nsrc, nseg * self.advance), dtype=np.float32)
+            np.multiply(wave, win[:self.length], out=seg[:, :, :self.length])
+            seg = seg.reshape(n, nsrc, nseg, self.advance).transpose(1, 0, 2, 3)
+            # フレームを advance 長のセグメントに分け、ずらしながら足し込む
+            for k in range(nseg):
+                blocks[:, start + k:stop + k] += seg[:, :, k]
+        blocks /= self._ola_norm
+        return out[:, :(nframes - 1) * self.advance + self.length]
+
+
+def pack_sources(outputs, nbin=257):
+    '''GHDSS の出力（フレームごとの {音源ID: スペクトル} の辞書のリスト）を
+    (フレーム数, 音源数, 周波数ビン数) の配列にまとめる。
+    音源が存在しないフレームは 0 で埋める。
+    音源IDのリストと配列を返す。
+    '''
+    ids = sorted({k for g in outputs for k in g.keys()})
+    index = {k: i for i, k in enumerate(ids)}
+    spec = np.zeros((len(outputs), len(ids), nbin), dtype=np.complex64)
+    for t, g in enumerate(outputs):
+        for k, v in g.items():
+            spec[t, index[k]] = v
+    return ids, spec
+
+
+def main():
+    '''MultiFFT / Synthesize とバッチ型エンジンの出力・処理時間を比較する。'''
+
+    import soundfile as sf
+
+    import hark
+
+    if len(sys.argv) < 2:
+        print("no input file")
+        return
+    wavfilename = sys.argv[1]
+
+    audio, rate = sf.read(wavfilename, dtype=np.float32)
+    frame_size = 512
+    advance = 160
+    engine = BatchSTFT(frame_size, advance, sampling_rate=rate)
+
+    # MultiFFT との比較
+    t0 = time.perf_counter()
+    frames = sliding_window_view(audio, frame_size, axis=0)[::advance, :, :]
+    spec_hark = hark.node.MultiFFT()(INPUT=frames).OUTPUT
+    t1 = time.perf_counter()
+    spec = engine.stft(audio)
+    t2 = time.perf_counter()
+
+    err = np.max(np.abs(spec - spec_hark)) / np.max(np.abs(spec_hark))
+    print("STFT: frames={} MultiFFT={:.3f}s batch={:.3f}s speedup={:.1f}x "
+          "max relative error={:.2e}".format(
+              spec.shape[0], t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), err))
+
+    # Synthesize との比較（全チャネルを音源とみなして合成する）
+    sources = [{c: s[c] for c in range(s.shape[0])} for s in spec_hark]
+    t0 = time.perf_counter()
+    wave_hark = hark.node.Synthesize()(INPUT=sources).OUTPUT
+    t1 = time.perf_counter()
+    ids, packed = pack_sources(sources, engine.nbin)
+    wave = engine.istft(packed)
+    t2 = time.perf_counter()
+
+    wave_hark = np.stack(
+        [np.concatenate([w[c] for w in wave_hark]) for c in ids])
+    n = min(wave.shape[1], wave_hark.shape[1])
+    err = np.max(np.abs(wave[:, :n] - wave_hark[:, :n])) \
+        / np.max(np.abs(wave_hark[:, :n]))
+    print("ISTFT: Synthesize={:.3f}s batch={:.3f}s speedup={:.1f}x "
+          "max relative error={:.2e}".format(
+              t1 - t0, t2 - t1, (t1 - t0) / (t2 - t1), err))
+
+
+if __name__ == '__main__':
+    main()
+
+# end of file
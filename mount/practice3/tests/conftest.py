@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def tf_filename():
+    return os.path.join(ROOT, "tf.zip")
@@ -0,0 +1,74 @@
+import os
+import zipfile
+
+from checkpoint import Checkpointer
+from ghdss_warmstart import WarmStartStore
+
+
+def _write_w(filename, content):
+    '''GHDSS が書き出す分離行列の代わりに、content を含む zip を書く。'''
+    with zipfile.ZipFile(filename, "w") as zf:
+        zf.writestr("W.dat", content)
+
+
+def _read_w(filename):
+    with zipfile.ZipFile(filename) as zf:
+        return zf.read("W.dat")
+
+
+def test_capture_copies_only_complete_exports(tmp_path, tf_filename):
+    store = WarmStartStore(str(tmp_path))
+    key = store.key(tf_filename, nch=8)
+    assert store.capture(key) is None
+
+    _write_w(store.export(key), b"W1" * 1000)
+    path = store.capture(key)
+    assert path == store.capture_path(key)
+    assert _read_w(path) == b"W1" * 1000
+
+    # 書き込み途中のファイルは保存せず、前回の保存を残す
+    with open(store.export(key), "rb") as f:
+        data = f.read()
+    _write_w(store.export(key), b"W2" * 1000)
+    with open(store.export(key), "r+b") as f:
+        f.truncate(len(data) // 2)
+    assert store.capture(key) is None
+    assert _read_w(path) == b"W1" * 1000
+    assert not [n for n in os.listdir(str(tmp_path)) if n.endswith(".tmp")]
+
+    assert not store.commit(key)
+    assert store.initial(key) is None
+
+
+def test_interrupted_run_keeps_ghdss_attachment(tmp_path, tf_filename):
+    store = WarmStartStore(str(tmp_path / "snapshots"))
+    key = store.key(tf_filename, nch=8)
+    ckpt = str(tmp_path / "run.ckpt")
+
+    # 実行中: 分離のプロセスが書き出した分離行列をコピーし、定期的に保存する
+    # （pipeline_mp.main の save_checkpoint と同じ添付ファイルの選び方）
+    checkpointer = Checkpointer(ckpt)
+    _write_w(store.export(key), b"W1")
+    checkpointer.submit({"frame": 100},
+                        files={"ghdss": store.capture(key)})
+    checkpointer.close()
+
+    # 中断: 分離のプロセスは終了時に書き出した分離行列を commit し、
+    # その後でメインプロセスが最後のチェックポイントを保存する
+    checkpointer = Checkpointer(ckpt)
+    checkpointer.load()
+    _write_w(store.export(key), b"W2")
+    assert store.commit(key)
+    checkpointer.submit({"frame": 200},
+                        files={"ghdss": store.initial(key)})
+    checkpointer.close()
+
+    # 再開: 最後のチェックポイントに分離行列が添付されている
+    state = Checkpointer(ckpt).load()
+    assert state["frame"] == 200
+    attachment = state["files"]["ghdss"]
+    assert _read_w(attachment) == b"W2"
+
+    resumed = WarmStartStore(str(tmp_path / "resumed"))
+    resumed.restore(key, attachment)
+    assert _read_w(resumed.initial(key)) == b"W2"
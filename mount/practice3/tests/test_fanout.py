@@ -0,0 +1,66 @@
+import os
+import socket
+import time
+
+import numpy as np
+
+from fanout import FanoutPublisher, FanoutSubscriber
+
+
+def _wait(cond, timeout=5.0):
+    t = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > t:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_silent_client_does_not_block_subscribers(tmp_path):
+    path = os.path.join(str(tmp_path), "fanout.sock")
+    publisher = FanoutPublisher(path, handshake_timeout=0.2)
+    try:
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.connect(path)
+        subscriber = FanoutSubscriber(path, ["sources"])
+        assert _wait(lambda: len(publisher.consumers) == 1)
+        publisher.publish("sources", 3, 0, {"id": np.arange(2)})
+        topic, frame, _, arrays = subscriber.recv()
+        assert (topic, frame) == ("sources", 3)
+        np.testing.assert_array_equal(arrays["id"], np.arange(2))
+        # 購読を送らない接続は handshake_timeout 後に閉じられる
+        silent.settimeout(2.0)
+        assert silent.recv(1) == b""
+        silent.close()
+        subscriber.close()
+    finally:
+        publisher.close()
+
+
+def test_dropped_is_cumulative_over_disconnects(tmp_path):
+    path = os.path.join(str(tmp_path), "fanout.sock")
+    publisher = FanoutPublisher(path, max_messages=1)
+    try:
+        slow = FanoutSubscriber(path, ["*"])
+        assert _wait(lambda: len(publisher.consumers) == 1)
+        big = {"data": np.zeros(1 << 20, dtype=np.uint8)}
+        for t in range(16):
+            publisher.publish("separation", t, 0, big)
+        dropped = publisher.dropped
+        assert dropped > 0
+
+        # 切断した利用者を除いても累計は減らない
+        slow.close()
+        consumer = publisher.consumers[0]
+        for t in range(16):
+            publisher.publish("separation", t, 0, big)
+            if not consumer.alive:
+                break
+        assert _wait(lambda: not consumer.alive)
+        dropped = publisher.dropped
+        other = FanoutSubscriber(path, ["sources"])
+        assert _wait(lambda: consumer not in publisher.consumers)
+        assert publisher.dropped == dropped
+        other.close()
+    finally:
+        publisher.close()
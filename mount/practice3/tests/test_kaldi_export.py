@@ -0,0 +1,48 @@
+import os
+import struct
+
+import numpy as np
+
+import kaldi_export
+from kaldi_export import ArkWriter, read_matrix
+
+
+def test_ark_round_trip_and_sorted_scp(tmp_path):
+    ark = os.path.join(str(tmp_path), "feats", "input.ark")
+    a = np.arange(6, dtype=np.float32).reshape(2, 3)
+    b = np.ones((4, 3), dtype=np.float64)
+    with ArkWriter(ark, buffer_size=16) as writer:
+        offset_b = writer.write("utt_b", b)
+        offset_a = writer.write("utt_a", a)
+    assert writer.count == 2
+
+    with open(ark, "rb") as f:
+        data = f.read()
+    # キー、空白、バイナリ行列のヘッダの順に並ぶ
+    assert data.startswith(b"utt_b \0BFM \x04")
+    assert struct.unpack("<bibi", data[offset_b + 5:offset_b + 15]) \
+        == (4, 4, 4, 3)
+    assert data[offset_a - len("utt_a "):offset_a] == b"utt_a "
+
+    np.testing.assert_array_equal(read_matrix(ark, offset_a), a)
+    np.testing.assert_array_equal(read_matrix(ark, offset_b), b)
+
+    with open(writer.scp) as f:
+        lines = f.read().splitlines()
+    assert writer.scp == os.path.join(str(tmp_path), "feats", "input.scp")
+    assert lines == ["utt_a {}:{}".format(ark, offset_a),
+                     "utt_b {}:{}".format(ark, offset_b)]
+
+
+def test_export_splits_utterances_by_source(tmp_path):
+    features = [{1: [1.0, 1.0]}, {1: [2.0, 2.0], 2: [5.0, 5.0]}, {2: [6.0, 6.0]}]
+    sources = [[{"id": 1}], [{"id": 1}, {"id": 2}], {2: None}]
+    ark = os.path.join(str(tmp_path), "x.ark")
+    with ArkWriter(ark) as writer:
+        assert kaldi_export.export(writer, "x", features, sources) == 2
+    with open(writer.scp) as f:
+        index = dict(line.split() for line in f)
+    assert sorted(index) == ["x_0001_0000000", "x_0002_0000001"]
+    offset = int(index["x_0002_0000001"].rsplit(":", 1)[1])
+    np.testing.assert_array_equal(read_matrix(ark, offset),
+                                  [[5.0, 5.0], [6.0, 6.0]])
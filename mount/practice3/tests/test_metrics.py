@@ -0,0 +1,20 @@
+from metrics import PipelineMetrics
+
+
+def test_render_counters_and_latency():
+    metrics = PipelineMetrics()
+    dropped = [0]
+    metrics.frames_dropped.func = lambda: dropped[0]
+    metrics.frames_pushed.inc(3)
+    metrics.frames_consumed.inc(2)
+    dropped[0] = 4
+    text = metrics.registry.render()
+    assert "hark_frames_dropped_total 4.0" in text
+    assert "hark_publisher_queue_depth 1.0" in text
+    assert "hark_end_to_end_seconds_count 0" in text
+
+    for v in (0.01, 0.02, 0.03):
+        metrics.end_to_end_seconds.observe(v)
+    text = metrics.registry.render()
+    assert "hark_end_to_end_seconds_count 3" in text
+    assert 'hark_end_to_end_seconds{quantile="0.5"} 0.02' in text
@@ -0,0 +1,55 @@
+import numpy as np
+
+import harktf
+from music_engine import OnlineMUSIC
+
+
+def _frames(tf, direction, nframes=120, seed=0):
+    '''direction から到来する白色信号に弱い雑音を加えたスペクトル列を作る。'''
+    rng = np.random.default_rng(seed)
+    a = tf.localization[direction]
+    s = rng.standard_normal((nframes, a.shape[1])) \
+        + 1j * rng.standard_normal((nframes, a.shape[1]))
+    noise = 0.05 * (rng.standard_normal((nframes,) + a.shape)
+                    + 1j * rng.standard_normal((nframes,) + a.shape))
+    return (a[None] * s[:, None, :] + noise).astype(np.complex64)
+
+
+def _run(engine, spec, noise_cm=None):
+    out = None
+    for frame in spec:
+        out = engine.push(frame, noise_cm)
+    return out
+
+
+def test_online_gevd_accepts_flat_noise_cm(tf_filename):
+    tf = harktf.load_tf(tf_filename, separation=False)
+    spec = _frames(tf, direction=10)
+    nch, nbin = tf.nch, spec.shape[-1]
+    # practice3-3.py と同じ (フレーム数, 周波数ビン数, ch*ch) の形
+    flat = np.broadcast_to(np.eye(nch, dtype=np.complex64).flatten(),
+                           (len(spec), nbin, nch * nch))
+
+    gevd = _run(OnlineMUSIC(tf, music_algorithm="GEVD", num_source=1,
+                            period=10), spec, flat)
+    sevd = _run(OnlineMUSIC(tf, music_algorithm="SEVD", num_source=1,
+                            period=10), spec)
+    assert [s["id"] for s in gevd] == [s["id"] for s in sevd] == [10]
+    np.testing.assert_allclose([s["power"] for s in gevd],
+                               [s["power"] for s in sevd], atol=1e-2)
+
+
+def test_online_gevd_single_frame_layouts(tf_filename):
+    tf = harktf.load_tf(tf_filename, separation=False)
+    spec = _frames(tf, direction=30)
+    nch, nbin = tf.nch, spec.shape[-1]
+    eye = np.eye(nch, dtype=np.complex64)
+    layouts = [
+        eye,
+        np.broadcast_to(eye, (nbin, nch, nch)),
+        np.broadcast_to(eye.flatten(), (nbin, nch * nch)),
+    ]
+    for cm in layouts:
+        out = _run(OnlineMUSIC(tf, music_algorithm="GEVD", num_source=1,
+                               period=10), spec, cm)
+        assert [s["id"] for s in out] == [30]
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+from recorder import RecordingTap
+
+
+def test_rotate_bytes_follows_subtype(tmp_path):
+    filename = os.path.join(str(tmp_path), "rec.wav")
+    limit = 3 * 2 * 1600        # PCM_24・2ch で 1600 サンプル分
+    tap = RecordingTap(filename, 16000, 2, subtype="PCM_24",
+                       rotate_bytes=limit)
+    block = np.zeros((160, 2), dtype=np.int16)
+    for _ in range(35):
+        tap.put(block)
+    tap.close()
+    assert tap.dropped == 0
+    frames = [sf.info(f).frames for f in tap.files]
+    assert frames == [1600, 1600, 1600, 800]
+    for f in tap.files[:-1]:
+        # ヘッダを除いた音声データの量が上限に一致する
+        assert os.path.getsize(f) - limit < 1024
@@ -0,0 +1,88 @@
+import numpy as np
+
+from ringbuffer import SharedRingBuffer
+
+
+FIELDS = {"spec": ((2, 3), np.complex64), "count": ((1,), np.int32)}
+
+
+def _ring(**kwargs):
+    return SharedRingBuffer(FIELDS, **kwargs)
+
+
+def test_round_trip_and_order():
+    ring = _ring(nslots=4, nreaders=2)
+    try:
+        for t in range(3):
+            assert ring.write(t, 1000 + t, spec=np.full((2, 3), t),
+                              count=[t])
+        for reader in range(2):
+            for t in range(3):
+                frame, t_ns, slot = ring.read(reader)
+                assert (frame, t_ns) == (t, 1000 + t)
+                np.testing.assert_array_equal(slot["spec"], np.full((2, 3), t))
+                assert slot["count"][0] == t
+                ring.release(reader)
+            assert ring.read(reader, timeout=0.01) is None
+        ring.close()
+        assert ring.read(0) is None
+    finally:
+        ring.detach()
+
+
+def test_full_ring_waits_for_slowest_reader():
+    ring = _ring(nslots=2, nreaders=2)
+    try:
+        for t in range(2):
+            ring.write(t, 0, count=[t])
+        ring.read(0)
+        ring.release(0)
+        # 読み出し側 1 が読んでいないので空きはない
+        assert ring.reserve(timeout=0.01) is None
+        assert not ring.write(2, 0, timeout=0.01, count=[2])
+        assert ring.reserve(alive=lambda: False) is None
+    finally:
+        ring.detach()
+
+
+def test_leave_stops_writer_waiting():
+    ring = _ring(nslots=2, nreaders=2)
+    try:
+        for t in range(2):
+            ring.write(t, 0, count=[t])
+        for t in range(2):
+            ring.read(0)
+            ring.release(0)
+        ring.leave(1)
+        assert ring.write(2, 0, timeout=0.01, count=[2])
+        frame, _, slot = ring.read(0)
+        assert frame == 2 and slot["count"][0] == 2
+        ring.release(0)
+        # すべての読み出し側が終了した場合は待たずに書き込める
+        ring.leave(0)
+        for t in range(3, 8):
+            assert ring.write(t, 0, timeout=0.01, count=[t])
+    finally:
+        ring.detach()
+
+
+def test_attach_in_another_process():
+    import multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    ring = _ring(nslots=4)
+    try:
+        p = ctx.Process(target=_child_write, args=(ring,))
+        p.start()
+        frame, t_ns, slot = ring.read(0, timeout=30)
+        assert (frame, t_ns) == (7, 8)
+        np.testing.assert_array_equal(slot["spec"], np.ones((2, 3)))
+        ring.release(0)
+        p.join()
+        assert p.exitcode == 0
+    finally:
+        ring.detach()
+
+
+def _child_write(ring):
+    ring.write(7, 8, spec=np.ones((2, 3)), count=[1])
+    ring.detach()
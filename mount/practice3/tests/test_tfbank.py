@@ -0,0 +1,38 @@
+import tfbank
+from tfbank import TFBank
+
+
+def test_localization_only_skips_separation(tf_filename):
+    bank = TFBank(profiles={"default": tf_filename})
+    loc = bank.get(separation=False)
+    assert loc.localization is not None and loc.separation is None
+    assert bank.get(separation=False) is loc
+    assert (bank.hits, bank.misses) == (1, 1)
+
+    # 両方を読み込んだ後は、定位のみの要求にもそれを返す
+    full = bank.get()
+    assert full.separation is not None
+    assert full.nbytes > loc.nbytes
+    assert bank.get(separation=False) in (loc, full)
+
+
+def test_budget_from_environment(monkeypatch, tf_filename):
+    monkeypatch.setenv("HARK_TF_BUDGET_MB", "0.5")
+    bank = TFBank(profiles={"default": tf_filename})
+    assert bank.budget_bytes == 512 * 1024
+    monkeypatch.delenv("HARK_TF_BUDGET_MB")
+    assert TFBank(profiles={}).budget_bytes == 256 * 1024 * 1024
+
+
+def test_shared_bank_budget(monkeypatch, tf_filename):
+    monkeypatch.setattr(tfbank, "_bank", None)
+    shared = tfbank.bank(budget_bytes=1)
+    assert shared.budget_bytes == 1
+    shared.profiles = {"a": tf_filename}
+    shared.get("a", separation=False)
+    shared.get("a", localization=False)
+    # 最後に読み込んだもの以外は budget を超えるので破棄される
+    assert len(shared._cache) == 1 and shared.evictions == 1
+    assert tfbank.bank() is shared
+    tfbank.bank(budget_bytes=2)
+    assert shared.budget_bytes == 2
@@ -0,0 +1,148 @@
+'''アレイの種類（プロファイル）ごとの伝達関数を管理するモジュール。
+プロファイル名から伝達関数ファイルのパスを引き、HARK のノードの
+A_MATRIX / TF_CONJ_FILENAME に与える。
+NumPy で実装したエンジン（music_engine など）向けには、
+読み込んだ伝達関数をプロセス内で共有し、合計バイト数が budget を超えたら
+最も長く使われていないプロファイルから破棄する。
+共有する配列は書き込み不可にしてあるので、利用側で変更してはならない。
+
+プロファイルは tf_profiles.json（{"名前": "パス", ...}）に書く。
+ファイルが無い場合は "default" のみが tf.zip を指す。
+使用するプロファイルは環境変数 HARK_TF_PROFILE で選ぶ。
+プロセスで共有する TFBank の budget は環境変数 HARK_TF_BUDGET_MB
+（既定は 256）か bank(budget_bytes=...) で変更できる。
+'''
+
+import collections
+import json
+import os
+import threading
+
+import harktf
+
+
+PROFILES_FILE = "tf_profiles.json"
+DEFAULT_PROFILES = {"default": "tf.zip"}
+DEFAULT_BUDGET_MB = 256
+
+
+def default_budget():
+    '''環境変数 HARK_TF_BUDGET_MB（無ければ DEFAULT_BUDGET_MB）をバイト数で返す。'''
+    mb = float(os.environ.get("HARK_TF_BUDGET_MB", DEFAULT_BUDGET_MB))
+    return int(mb * 1024 * 1024)
+
+
+def load_profiles(filename=PROFILES_FILE):
+    '''プロファイルの定義を読み込む。相対パスはファイルの場所から解決する。'''
+    if not os.path.exists(filename):
+        return dict(DEFAULT_PROFILES)
+    with open(filename) as f:
+        profiles = json.load(f)
+    base = os.path.dirname(filename)
+    return {name: os.path.join(base, path) for name, path in profiles.items()}
+
+
+class TFBank:
+    '''プロファイルごとの TransferFunction を LRU で保持するクラス。
+
+        bank = TFBank(budget_bytes=64 * 1024 * 1024)
+        filename = bank.path("tamago")     # HARK のノードに与えるパス
+        tf = bank.get("tamago")            # 読み込み済みなら共有のものを返す
+        tf = bank.get("tamago", separation=False)   # 定位用のみ
+
+    budget_bytes を省略すると default_budget() を使う。
+    '''
+
+    def __init__(self, profiles=None, budget_bytes=None):
+        self.profiles = load_profiles() if profiles is None else profiles
+        self.budget_bytes = (default_budget() if budget_bytes is None
+                             else budget_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(tf.nbytes for tf in self._cache.values())
+
+    def path(self, name=None):
+        '''プロファイル name の伝達関数ファイルのパスを返す。
+        name を省略すると HARK_TF_PROFILE（無ければ "default"）を使う。
+        プロファイルに無い名前はファイルのパスとみなす。
+        '''
+        if name is None:
+            name = os.environ.get("HARK_TF_PROFILE", "default")
+        if name in self.profiles:
+            return self.profiles[name]
+        if os.path.exists(name):
+            return name
+        raise KeyError("unknown transfer function profile: " + repr(name))
+
+    def get(self, name=None, localization=True, separation=True):
+        '''プロファイル name の TransferFunction を返す。
+        localization / separation に False を与えると、該当する伝達関数を
+        読み込まない（定位のみを行う場合に分離用を保持しないため）。
+        両方を読み込み済みのものがあれば、それを返す。
+        '''
+        filename = self.path(name)
+        key = (filename, localization, separation)
+        with self._lock:
+            for k in (key, (filename, True, True)):
+                tf = self._cache.get(k)
+                if tf is not None:
+                    self._cache.move_to_end(k)
+                    self.hits += 1
+                    return tf
+            # 同じプロファイルを複数のスレッドが同時に読み込まないよう
+            # ロックを保持したまま読み込む
+            self.misses += 1
+            tf = harktf.load_tf(filename, localization=localization,
+                                separation=separation)
+            for a in (tf.positions, tf.mic_positions,
+                      tf.localization, tf.separation):
+                if a is not None:
+                    a.flags.writeable = False
+            self._cache[key] = tf
+            self._evict()
+            return tf
+
+    def _evict(self):
+        # 最後に読み込んだものは budget を超えていても残す
+        while len(self._cache) > 1 and self.nbytes > self.budget_bytes:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def bank(budget_bytes=None):
+    '''プロセスで共有する TFBank を返す。
+    budget_bytes を与えると共有の TFBank の budget をその値に変更する。
+    '''
+    global _bank
+    with _bank_lock:
+        if _bank is None:
+            _bank = TFBank(budget_bytes=budget_bytes)
+        elif budget_bytes is not None:
+            with _bank._lock:
+                _bank.budget_bytes = budget_bytes
+                _bank._evict()
+    return _bank
+
+
+def path(name=None):
+    return bank().path(name)
+
+
+def get(name=None, localization=True, separation=True):
+    return bank().get(name, localization=localization, separation=separation)
+
+# end of file